@@ -0,0 +1,177 @@
+import argparse
+import copy
+import json
+import platform
+import statistics
+import time
+
+import numpy as np
+
+import kernels
+import simulation_cp
+from route import Route
+from simulation import Simulation
+from vehicle import Vehicle
+
+# Reference courses of test.ipynb: (segments, delta_s), the segments being (distance, incline angle, mu)
+SCENARIOS = {
+    'flat': (((10, 0, 0.015),), 0.5),
+    'flat_fine': (((10, 0, 0.015),), 0.25),
+    'ramp': (((10, 5, 0.015),), 0.5),
+    'two_hills': (((4, 5, 0.015), (2, -5, 0.015), (4, 5, 0.015)), 0.5),
+}
+
+# Long route variants multiply the segment lengths, at the same delta_s
+LONG_SCALE = 100
+
+
+def reference_vehicle():
+    """Vehicle of the notebook experiments."""
+    return Vehicle(mass=18000, frontal_area=8.16, velocity_init=5, energy_left=15000, velocity_max=60, energy_max=15000)
+
+
+def scenarios(long_scale=LONG_SCALE):
+    """Returns the benchmarked courses, the reference ones and their long variants, as name: (segments, delta_s)."""
+    courses = dict(SCENARIOS)
+    if long_scale:
+        for name, (segments, delta_s) in SCENARIOS.items():
+            courses[f'{name}_long'] = (tuple((distance * long_scale, angle, mu) for distance, angle, mu in segments), delta_s)
+    return courses
+
+
+def measure(function, repeats, setup=None):
+    """
+    Times function over a number of runs.
+
+    Parameters:
+        function (callable): Called with the result of setup, or without argument.
+        repeats (int): Number of timed runs.
+        setup (callable): Optional untimed preparation of each run.
+
+    Returns:
+        list of float: Wall time of each run in seconds.
+    """
+    timings = []
+    for _ in range(repeats):
+        args = () if setup is None else (setup(),)
+        start = time.perf_counter()
+        function(*args)
+        timings.append(time.perf_counter() - start)
+    return timings
+
+
+def _case(scenario, operation, timings, n_steps, work=None):
+    """Benchmark record, work is the number of units (e.g. rollouts) done by one run."""
+    median = statistics.median(timings)
+    record = {'scenario': scenario,
+              'operation': operation,
+              'steps': n_steps,
+              'median_s': median,
+              'min_s': min(timings),
+              'max_s': max(timings),
+              'repeats': len(timings)}
+    if work is not None:
+        record['work'] = work
+        record['per_second'] = work / median if median > 0 else float('inf')
+    return record
+
+
+def benchmark_course(name, segments, delta_s, repeats=5, n_rollouts=10000, dp_bins=41, seed=0):
+    """
+    Runs every benchmark on one course.
+
+    Parameters:
+        name (str): Name of the course in the report.
+        segments (tuple): Segments of the Route.
+        delta_s (float): Distance interval of the Route and distance step of the simulations.
+        repeats (int): Timed runs per benchmark, their median is reported.
+        n_rollouts (int): Rollouts of the random search benchmark.
+        dp_bins (int): Velocity and energy nodes of the DP grid.
+        seed (int): Seed of the random choices.
+
+    Returns:
+        list of dict: One record per benchmark.
+    """
+    route = Route(segments, delta_s=delta_s)
+    n_steps = len(route)
+    vehicle = reference_vehicle()
+    rng = np.random.default_rng(seed)
+    records = []
+
+    records.append(_case(name, 'route_construction', measure(lambda: Route(segments, delta_s=delta_s), repeats), n_steps))
+
+    def simulation(backend='python'):
+        return Simulation(copy.deepcopy(vehicle), route, distance_step=delta_s, rng=rng, backend=backend)
+
+    records.append(_case(name, 'simulate', measure(Simulation.simulate, repeats, setup=simulation), n_steps))
+    backends = ['interpreted'] + (['numba'] if kernels.NUMBA_AVAILABLE else [])
+    for backend in backends:
+        # The first run compiles the kernel
+        simulation(backend).simulate()
+        records.append(_case(name, f'simulate_{backend}', measure(Simulation.simulate, repeats,
+                                                                  setup=lambda: simulation(backend)), n_steps))
+
+    timings = measure(lambda sim: sim.simulate_batch(n_rollouts, rng=rng), repeats, setup=simulation)
+    records.append(_case(name, 'random_search', timings, n_steps, work=n_rollouts))
+
+    def dynamic_programming():
+        return simulation_cp.Simulation(copy.deepcopy(vehicle), route, distance_step=delta_s)
+
+    timings = measure(lambda sim: sim.dynamic_programming_approach(dp_bins, dp_bins), repeats, setup=dynamic_programming)
+    records.append(_case(name, 'dynamic_programming', timings, n_steps))
+    return records
+
+
+def run_benchmarks(repeats=5, n_rollouts=10000, long_scale=LONG_SCALE, dp_bins=41, seed=0, output=None):
+    """
+    Benchmarks the simulators and optimizers on the reference courses and their long variants.
+
+    Parameters:
+        repeats (int): Timed runs per benchmark.
+        n_rollouts (int): Rollouts of the random search benchmark, divided by long_scale on the long variants.
+        long_scale (int): Length factor of the long variants, 0 leaves them out.
+        dp_bins (int): Velocity and energy nodes of the DP grid.
+        seed (int): Seed of the random choices.
+        output (str): Optional path of the JSON report.
+
+    Returns:
+        dict: The report, with the environment under 'meta' and one record per benchmark under 'cases'.
+    """
+    if repeats <= 0:
+        raise ValueError("Number of repeats must be positive.")
+
+    report = {'meta': {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'python': platform.python_version(),
+                       'numpy': np.__version__,
+                       'numba': kernels.numba.__version__ if kernels.NUMBA_AVAILABLE else None,
+                       'machine': platform.machine(),
+                       'repeats': repeats,
+                       'n_rollouts': n_rollouts,
+                       'dp_bins': dp_bins,
+                       'seed': seed},
+              'cases': []}
+    for name, (segments, delta_s) in scenarios(long_scale).items():
+        # Long courses run fewer rollouts, for about the same number of simulated steps
+        rollouts = max(n_rollouts // long_scale, 1) if name.endswith('_long') else n_rollouts
+        report['cases'].extend(benchmark_course(name, segments, delta_s, repeats, rollouts, dp_bins, seed))
+
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks of the simulators and optimizers.")
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--rollouts', type=int, default=10000)
+    parser.add_argument('--long-scale', type=int, default=LONG_SCALE)
+    parser.add_argument('--dp-bins', type=int, default=41)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark.json')
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.repeats, args.rollouts, args.long_scale, args.dp_bins, args.seed, args.output)
+    for case in report['cases']:
+        rate = f", {case['per_second']:.0f}/s" if 'per_second' in case else ''
+        print(f"{case['scenario']:>16} {case['operation']:<20} {case['median_s'] * 1000:10.3f} ms{rate}")
@@ -0,0 +1,74 @@
+import json
+import time
+from contextlib import contextmanager
+
+
+class Instrumentation:
+    def __init__(self, callbacks=()):
+        """
+        Opt-in timers, counters and per-step probes of the simulators.
+
+        A simulation given an Instrumentation accumulates the wall time of its phases and counts its
+        steps, rollouts, early terminations on energy exhaustion and velocity clamp hits. Without one,
+        the simulators skip the accounting and pay nothing but a no-op clock.
+
+        Parameters:
+            callbacks (sequence of callable): Probes called as callback(simulation, step) after every
+                                              step of the step by step simulations.
+
+        Attributes:
+            timers (dict): Total seconds spent in each phase.
+            calls (dict): Number of timed sections of each phase.
+            counters (dict): Event counts by name.
+        """
+        self.callbacks = list(callbacks)
+        self.timers = {}
+        self.calls = {}
+        self.counters = {}
+
+    def add_callback(self, callback):
+        """Registers a probe called as callback(simulation, step) after every step."""
+        self.callbacks.append(callback)
+
+    def step(self, simulation, step):
+        """Runs the probes after a step."""
+        for callback in self.callbacks:
+            callback(simulation, step)
+
+    def count(self, name, n=1):
+        """Adds n to a counter."""
+        self.counters[name] = self.counters.get(name, 0) + n
+
+    def add_time(self, name, seconds, calls=1):
+        """Adds seconds to the timer of a phase."""
+        self.timers[name] = self.timers.get(name, 0.0) + seconds
+        self.calls[name] = self.calls.get(name, 0) + calls
+
+    @contextmanager
+    def timer(self, name):
+        """Times the body of a with statement as a phase, e.g. Route construction."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def reset(self):
+        """Clears the timers and counters, the probes stay registered."""
+        self.timers.clear()
+        self.calls.clear()
+        self.counters.clear()
+
+    def to_dict(self):
+        """Returns the timers, with their number of calls and mean, and the counters."""
+        return {'timers': {name: {'total': total, 'calls': self.calls[name], 'mean': total / self.calls[name]}
+                           for name, total in self.timers.items()},
+                'counters': dict(self.counters)}
+
+    def to_json(self, path=None):
+        """Returns to_dict as a JSON string, also written to path if given."""
+        text = json.dumps(self.to_dict(), indent=2)
+        if path is not None:
+            with open(path, 'w') as f:
+                f.write(text)
+        return text
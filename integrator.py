@@ -0,0 +1,163 @@
+import numpy as np
+
+# Dormand-Prince 5(4) tableau, the dynamics do not depend on the distance so the nodes are not needed
+_A = ((),
+      (1 / 5,),
+      (3 / 40, 9 / 40),
+      (44 / 45, -56 / 15, 32 / 9),
+      (19372 / 6561, -25360 / 2187, 64448 / 6561, -212 / 729),
+      (9017 / 3168, -355 / 33, 46732 / 5247, 49 / 176, -5103 / 18656),
+      (35 / 384, 0.0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84))
+_B = (35 / 384, 0.0, 500 / 1113, 125 / 192, -2187 / 6784, 11 / 84, 0.0)
+_B_LOW = (5179 / 57600, 0.0, 7571 / 16695, 393 / 640, -92097 / 339200, 187 / 2100, 1 / 40)
+
+
+class AdaptiveIntegrator:
+    def __init__(self, simulation, tolerance=1e-6, initial_step=None, max_step=None, min_step=1e-9):
+        """
+        Error controlled integration of the dynamics of simulation.Simulation in distance.
+
+        update_vehicle_state is the explicit Euler step of the PhysicsModel.rates of the simulation,
+            dv/ds = 1000 * a(v, P) / max(v, 5),  dE/ds = -(P + 0.740 * v) / max(v, 5),  dt/ds = 3600 / max(v, 5)
+        with a(v, P) = (P / v - gravity - friction - drag(v)) / mass and the default regeneration.
+        This integrator solves the same equations with the embedded Dormand-Prince 5(4) pair. The schedule still gives one candidate
+        of calculate_possible_output_power_value per sub-segment, u4 being the grade holding feedback
+        evaluated continuously. Consecutive sub-segments with the same incline, friction and candidate
+        are integrated as one interval, so constant stretches are covered with a few long steps,
+        while every segment boundary or power switch restarts from a short step that grows again.
+
+        Parameters:
+            simulation (Simulation): Gives the vehicle, the route, the constants and the step_distances.
+            tolerance (float): Relative tolerance of the local error on velocity, energy and time.
+            initial_step (float): First step after a boundary, default is a tenth of the smallest sub-segment.
+            max_step (float): Longest step, default is unbounded.
+            min_step (float): Shortest step, reached only when the tolerance cannot be met.
+        """
+        if tolerance <= 0:
+            raise ValueError("Tolerance must be positive.")
+        if min_step <= 0:
+            raise ValueError("Minimum step must be positive.")
+
+        self.simulation = simulation
+        self.tolerance = tolerance
+        self.initial_step = initial_step
+        self.max_step = max_step if max_step is not None else np.inf
+        self.min_step = min_step
+        self.n_steps = 0
+        self.n_rejected = 0
+
+    def _power(self, choice, velocity, sin_angle, cos_angle, mu):
+        """Candidate power of calculate_possible_output_power_value at the given velocity."""
+        sim = self.simulation
+        if choice < 3:
+            return sim.fixed_output_powers[choice]
+        return sim.physics.grade_power(velocity, sin_angle, cos_angle, mu)
+
+    def _derivatives(self, velocity, choice, road):
+        """Derivatives in distance of (velocity, energy, time), and the output power."""
+        sim = self.simulation
+        sin_angle, cos_angle, mu, gravity_force, friction_force = road
+        velocity = min(max(velocity, sim.min_velocity), sim.vehicle.velocity_max)
+        output_power = self._power(choice, velocity, sin_angle, cos_angle, mu)
+
+        dv, de, dt = sim.physics.rates(velocity, output_power, gravity_force, friction_force)
+        # The velocity stays on its bounds instead of pushing through them
+        if (velocity >= sim.vehicle.velocity_max and dv > 0) or (velocity <= sim.min_velocity and dv < 0):
+            dv = 0.0
+        return (dv, de, dt), output_power
+
+    def _step(self, state, h, choice, road):
+        """One Dormand-Prince step, returns the fifth order state and the scaled error norm."""
+        stages = []
+        for i in range(7):
+            y = list(state)
+            for j, a in enumerate(_A[i]):
+                if a:
+                    y = [y_m + h * a * k_m for y_m, k_m in zip(y, stages[j])]
+            stages.append(self._derivatives(y[0], choice, road)[0])
+
+        high = [y + h * sum(b * k[m] for b, k in zip(_B, stages)) for m, y in enumerate(state)]
+        low = [y + h * sum(b * k[m] for b, k in zip(_B_LOW, stages)) for m, y in enumerate(state)]
+        error = max(abs(h_m - l_m) / (self.tolerance * max(abs(s_m), abs(h_m), 1.0))
+                    for s_m, h_m, l_m in zip(state, high, low))
+        return high, error
+
+    def intervals(self, choices):
+        """
+        Groups consecutive sub-segments with the same incline, friction and candidate.
+
+        Returns:
+            list of tuple: (first sub-segment, last sub-segment + 1, length) of each interval.
+        """
+        route = self.simulation.route
+        choices = np.asarray(choices)
+        changes = ((np.diff(route.angle_array) != 0) | (np.diff(route.mu_array) != 0) | (np.diff(choices) != 0))
+        bounds = np.concatenate([[0], np.flatnonzero(changes) + 1, [len(choices)]])
+        lengths = np.add.reduceat(self.simulation.step_distances, bounds[:-1]) if len(choices) else []
+        return list(zip(bounds[:-1].tolist(), bounds[1:].tolist(), list(lengths)))
+
+    def integrate(self, choices):
+        """
+        Drives the route with the given schedule from the current vehicle state.
+
+        Parameters:
+            choices (ndarray of int): Index in 0..3 of the candidate used on each sub-segment.
+
+        Returns:
+            tuple: (time, distance, velocity, energy, output_power) traces at the accepted steps,
+                   output_power in kW like the state lists of Simulation. The integration stops
+                   after the step where the energy falls under 2, like simulate.
+        """
+        sim = self.simulation
+        route = sim.route
+        if len(choices) != len(route):
+            raise ValueError("Choices must have one value per route sub-segment.")
+
+        gravity_forces, friction_forces = route.road_forces(sim.vehicle.mass, sim.g)
+        initial_step = self.initial_step or 0.1 * float(np.min(sim.step_distances))
+        velocity_max, min_velocity = sim.vehicle.velocity_max, sim.min_velocity
+
+        state = [float(sim.vehicle.velocity), float(sim.vehicle.energy_left), float(sim.time)]
+        distance = float(sim.vehicle.covered_distance)
+        traces = [[state[2]], [distance], [state[0]], [state[1]], [float(sim.vehicle.output_power)]]
+        self.n_steps = self.n_rejected = 0
+
+        for first, _, length in self.intervals(choices):
+            choice = int(choices[first])
+            road = (route.sin_array[first], route.cos_array[first], route.mu_array[first],
+                    gravity_forces[first], friction_forces[first])
+            covered = 0.0
+            h = min(initial_step, self.max_step)
+            while covered < length:
+                h = min(h, length - covered)
+                output_power = self._derivatives(state[0], choice, road)[1]
+                new_state, error = self._step(state, h, choice, road)
+                if error > 1 and h > self.min_step:
+                    self.n_rejected += 1
+                    h = max(h * max(0.2, 0.9 * error ** -0.2), self.min_step)
+                    continue
+                if new_state[1] < 2 <= state[1] - self.tolerance * max(state[1], 1.0) and h > self.min_step:
+                    # Shorten the step to end where the energy falls under 2, simulate stops there
+                    self.n_rejected += 1
+                    h = max(h * min(max((state[1] - 2) / (state[1] - new_state[1]), 0.01), 0.99) * (1 + self.tolerance),
+                            self.min_step)
+                    continue
+
+                covered = length if length - covered - h <= 1e-12 * length else covered + h
+                new_state[0] = min(max(new_state[0], min_velocity), velocity_max)
+                new_state[1] = max(new_state[1], 0.0)
+                state = new_state
+                self.n_steps += 1
+
+                traces[0].append(state[2])
+                traces[1].append(distance + covered)
+                traces[2].append(state[0])
+                traces[3].append(state[1])
+                traces[4].append(abs(output_power / 1000))
+                if state[1] < 2:
+                    return tuple(np.array(trace) for trace in traces)
+
+                growth = 5.0 if error == 0 else min(5.0, max(0.2, 0.9 * error ** -0.2))
+                h = min(h * growth, self.max_step)
+            distance += length
+        return tuple(np.array(trace) for trace in traces)
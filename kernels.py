@@ -0,0 +1,123 @@
+import ctypes
+import ctypes.util
+import math
+
+import numpy as np
+
+try:
+    import numba
+except ImportError:  # The kernel is run by the interpreter instead
+    numba = None
+
+NUMBA_AVAILABLE = numba is not None
+
+# velocity ** 2 in Simulation goes through the C library pow, which may differ by one ulp from
+# the v * v that NumPy and Numba emit for a square. Calling the same pow keeps both paths identical.
+try:
+    _libm = ctypes.CDLL(ctypes.util.find_library('m') or ctypes.util.find_library('c'))
+    _pow = _libm.pow
+    _pow.argtypes = (ctypes.c_double, ctypes.c_double)
+    _pow.restype = ctypes.c_double
+except (OSError, AttributeError, TypeError):
+    _pow = math.pow
+
+
+def _rollout(sin_angles, cos_angles, mus, step_distances, choices, params, state,
+             time_out, distance_out, velocity_out, energy_out, power_out):
+    """
+    Runs simulation.Simulation.simulate over a whole route on flat float64 arrays, with the
+    transition of physics.PhysicsModel written out on scalars.
+
+    Parameters:
+        sin_angles, cos_angles, mus (ndarray): Per sub-segment sin, cos of the incline and friction coefficient.
+        step_distances (ndarray): Per sub-segment distance step, Simulation.step_distances.
+        choices (ndarray of int): Per sub-segment index of the candidate of calculate_possible_output_power_value.
+        params (ndarray): PhysicsModel.kernel_parameters, the model with a LinearRegeneration.
+        state (ndarray): Initial velocity, energy_left, covered_distance, time and output_power.
+        time_out, distance_out, velocity_out, energy_out, power_out (ndarray): Traces of length
+            steps + 1, filled up to the returned index like the state lists of Simulation.
+
+    Returns:
+        int: Number of steps taken, smaller than the number of sub-segments if the energy ran out.
+    """
+    mass, g, C_d, A, velocity_max, min_velocity = params[0], params[1], params[2], params[3], params[4], params[5]
+    velocity_floor, velocity_scale, time_scale = params[9], params[10], params[11]
+    grade_power_divisor, absolute_grade_power, regeneration = params[12], params[13], params[14]
+    velocity, energy, distance, elapsed = state[0], state[1], state[2], state[3]
+    time_out[0] = elapsed
+    distance_out[0] = distance
+    velocity_out[0] = velocity
+    energy_out[0] = energy
+    power_out[0] = state[4]
+
+    n_steps = len(choices)
+    for k in range(n_steps):
+        sin_angle = sin_angles[k]
+        cos_angle = cos_angles[k]
+        mu = mus[k]
+        distance_step = step_distances[k]
+
+        choice = choices[k]
+        if choice == 3:
+            output_power = mass * g * velocity * (sin_angle + mu * cos_angle) - C_d * A * _pow(velocity, 2.0) / 21.15
+            if absolute_grade_power:
+                output_power = abs(output_power)
+            output_power = output_power / grade_power_divisor
+        else:
+            output_power = params[6 + choice]
+
+        gravity_force = mass * g * sin_angle
+        friction_force = mass * g * cos_angle * mu
+        drag_force = C_d * A * _pow(velocity, 2.0) / 2
+        acceleration = (output_power / velocity - gravity_force - friction_force - drag_force) / mass
+
+        step_ratio = distance_step / max(velocity, velocity_floor)
+        new_velocity = max(min(velocity + acceleration * step_ratio * velocity_scale, velocity_max), min_velocity)
+        energy = max(energy - output_power * step_ratio + (-regeneration * velocity * step_ratio), 0.0)
+        distance = distance + distance_step
+        elapsed = elapsed + step_ratio * time_scale
+
+        time_out[k + 1] = elapsed
+        distance_out[k + 1] = distance
+        velocity_out[k + 1] = new_velocity
+        energy_out[k + 1] = energy
+        power_out[k + 1] = abs(output_power / 1000)
+
+        # Vehicle.update_velocity, then the min_velocity check of simulate
+        velocity = min(max(new_velocity, 0.0), velocity_max)
+        if velocity < min_velocity:
+            velocity = min_velocity
+
+        if energy < 2:
+            return k + 1
+    return n_steps
+
+
+rollout_python = _rollout
+rollout_numba = numba.njit(_rollout) if NUMBA_AVAILABLE else None
+
+
+def rollout(sin_angles, cos_angles, mus, step_distances, choices, params, state, backend='numba'):
+    """
+    Runs one rollout with the compiled kernel, or with the same kernel run by the Python interpreter.
+
+    Parameters:
+        sin_angles, cos_angles, mus, step_distances, choices, params, state: As in _rollout.
+        backend (str): 'numba' for the JIT kernel, falling back to 'interpreted' when Numba is not installed.
+
+    Returns:
+        tuple: (steps, time, distance, velocity, energy, output_power), the traces have steps + 1 values.
+    """
+    if backend not in ('interpreted', 'numba'):
+        raise ValueError("Backend must be 'interpreted' or 'numba'.")
+    n_steps = len(choices)
+    traces = np.empty((5, n_steps + 1))
+    kernel = rollout_numba if backend == 'numba' and NUMBA_AVAILABLE else rollout_python
+    if kernel is rollout_python:
+        # Python floats are much faster than NumPy scalars in the interpreted loop
+        args = (sin_angles.tolist(), cos_angles.tolist(), mus.tolist(), step_distances.tolist(), choices.tolist(),
+                params.tolist(), state.tolist())
+    else:
+        args = (sin_angles, cos_angles, mus, step_distances, choices, params, state)
+    steps = kernel(*args, traces[0], traces[1], traces[2], traces[3], traces[4])
+    return (steps,) + tuple(trace[:steps + 1] for trace in traces)
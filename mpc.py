@@ -0,0 +1,228 @@
+import time
+
+import numpy as np
+
+
+class MPCController:
+    def __init__(self, simulation, horizon=8, beam_width=32, latency_budget=1e-3, energy_weight=1.0):
+        """
+        Receding horizon controller choosing the output power of simulation_cp.Simulation online.
+
+        At each sub-segment, the candidates of possible_output_power_values are searched over the
+        next horizon sub-segments of the route with the transition of calculate_next_state, and the
+        first power of the best plan is applied. The look-ahead is a beam search: every level
+        expands the kept plans by the four candidates and keeps the beam_width best ones, scored by
+        their time plus an estimate of the time to go. The plan of the previous decision, shifted by
+        one sub-segment, is always kept in the beam, so the controller warm-starts from it and never
+        does worse than following it. The latency budget is checked before each level, from the
+        slowest level so far, and within each level after its transitions and after its scoring: a
+        level that would not fit is dropped and the decision is taken from the deepest complete one.
+        When not even the first level fits, the warm plan is followed. Only interpreter pauses
+        (garbage collection, scheduling) can still exceed the budget, latency_stats counts them.
+
+        The time to go is the remaining distance at the reached velocity. Beyond the horizon, the
+        energy is budgeted linearly along the route: a plan reaching the end of the window with less
+        than its share of the energy left is penalized by energy_weight time units per unit of energy.
+        This heuristic is myopic, the replayed times are somewhat slower than those of
+        dynamic_programming_approach; running this module prints the gap on a reference course.
+
+        Parameters:
+            simulation (simulation_cp.Simulation): Gives the vehicle, the route and the transition.
+            horizon (int): Number of sub-segments looked ahead.
+            beam_width (int): Number of plans kept at each level of the look-ahead.
+            latency_budget (float or None): Wall time allowed per decision in seconds, None for no limit.
+            energy_weight (float): Penalty of the energy below the linear budget at the end of the window.
+
+        Attributes:
+            latencies (list of float): Wall time of each decision in seconds.
+            depths (list of int): Depth of the look-ahead actually searched at each decision.
+            plan (list of int): Candidate indices planned from the last decision on.
+            tail_time (float): Longest time taken by the end of a decision, after the search, kept
+                               free in the budget.
+        """
+        if horizon < 1:
+            raise ValueError("Horizon must be at least one sub-segment.")
+        if beam_width < 1:
+            raise ValueError("Beam width must be positive.")
+        if latency_budget is not None and latency_budget <= 0:
+            raise ValueError("Latency budget must be positive.")
+
+        self.simulation = simulation
+        self.horizon = horizon
+        self.beam_width = beam_width
+        self.latency_budget = latency_budget
+        self.energy_weight = energy_weight
+
+        route = simulation.route
+        self.remaining_distance = np.concatenate([np.cumsum(simulation.step_distances[::-1])[::-1], [0.0]])
+        self.gravity_forces, self.friction_forces = route.road_forces(simulation.vehicle.mass, simulation.g)
+        self.reset()
+
+    def reset(self):
+        """Forgets the warm start and the latency statistics."""
+        self.plan = []
+        self.latencies = []
+        self.depths = []
+        self.initial_energy = None
+        self.tail_time = 0.0
+
+    def _terminal_cost(self, velocity, energy, step):
+        """Estimated time to go after sub-segment step - 1, with the energy budget penalty."""
+        sim = self.simulation
+        remaining = self.remaining_distance[step]
+        budget = self.initial_energy * remaining / self.remaining_distance[0]
+        return remaining / np.maximum(velocity, sim.min_velocity) + self.energy_weight * np.maximum(budget - energy, 0)
+
+    def _over_budget(self, start, margin=0.0):
+        """Whether the decision started at start has no time left for margin more seconds."""
+        return self.latency_budget is not None and time.perf_counter() - start + margin > self.latency_budget
+
+    def decide(self, step):
+        """
+        Chooses the output power of sub-segment step from the current vehicle state.
+
+        Returns:
+            float: The power to apply, a value of possible_output_power_values.
+        """
+        start = time.perf_counter()
+        sim = self.simulation
+        route = sim.route
+        if self.initial_energy is None:
+            self.initial_energy = sim.vehicle.energy_left
+
+        depth = min(self.horizon, len(route) - step)
+        warm = self.plan[1:depth + 1] if len(self.plan) > 1 else []
+        warm = warm + [warm[-1] if warm else 0] * (depth - len(warm))
+
+        # Beam of plans: reached state, time so far, first candidate and whether it follows the warm plan
+        velocity = np.array([float(sim.vehicle.velocity)])
+        energy = np.array([float(sim.vehicle.energy_left)])
+        cost = np.zeros(1)
+        on_warm = np.ones(1, dtype=bool)
+        actions = np.zeros((1, 0), dtype=np.int8)
+
+        searched = 0
+        slowest_level = 0.0
+        out_of_time = False
+        for level in range(depth):
+            level_start = time.perf_counter()
+            k = step + level
+            _, incline_angle, mu = route.road_info_list[k]
+            sin_cos = (route.sin_array[k], route.cos_array[k])
+            powers = sim.candidate_powers(velocity, incline_angle, mu, sin_cos)
+            new_velocity, new_energy, delta_t = sim.transition(velocity, energy, incline_angle, powers, mu,
+                                                               clamp_energy=False,
+                                                               road_forces=(self.gravity_forces[k], self.friction_forces[k]),
+                                                               distance_step=sim.step_distances[k])
+            # The rest of the level, about half of it, and the end of the decision must fit too
+            out_of_time = self._over_budget(start, 0.5 * slowest_level + self.tail_time)
+            if out_of_time:
+                break
+            # Children are ordered by candidate, then by parent
+            n = len(velocity)
+            new_velocity = new_velocity.ravel()
+            new_energy = new_energy.ravel()
+            new_cost = np.resize(cost + delta_t, 4 * n)
+            choice = np.repeat(np.arange(4, dtype=np.int8), n)
+            parent = np.resize(np.arange(n), 4 * n)
+            new_on_warm = on_warm[parent] & (choice == warm[level])
+
+            score = new_cost + self._terminal_cost(new_velocity, new_energy, k + 1)
+            score[new_energy < 0] = np.inf
+            out_of_time = self._over_budget(start, 0.25 * slowest_level + self.tail_time)
+            if out_of_time or not np.isfinite(score).any():
+                break
+
+            # Keep the best plans, and the warm plan whatever its score
+            if len(score) > self.beam_width:
+                keep = np.argpartition(score, self.beam_width - 1)[:self.beam_width]
+            else:
+                keep = np.arange(len(score))
+            keep = keep[np.isfinite(score[keep])]
+            if new_on_warm.any() and np.isfinite(score[new_on_warm]).all() and not new_on_warm[keep].any():
+                keep = np.append(keep, np.flatnonzero(new_on_warm))
+
+            velocity, energy, cost = new_velocity[keep], new_energy[keep], new_cost[keep]
+            on_warm = new_on_warm[keep]
+            actions = np.concatenate([actions[parent[keep]], choice[keep, None]], axis=1)
+            final_score = score[keep]
+            searched = level + 1
+
+            # Stop before a level that would likely exceed the budget
+            slowest_level = max(slowest_level, time.perf_counter() - level_start)
+            if level + 1 < depth and self._over_budget(start, slowest_level + self.tail_time):
+                break
+
+        tail_start = time.perf_counter()
+        if searched == 0:
+            # Out of time, follow the warm plan, or every candidate runs out of energy, coast
+            self.plan = warm if out_of_time else [0]
+        else:
+            self.plan = actions[int(np.argmin(final_score))].tolist()
+
+        _, incline_angle, mu = route.road_info_list[step]
+        power = sim.possible_output_power_values(incline_angle, mu, (route.sin_array[step], route.cos_array[step]))[self.plan[0]]
+        end = time.perf_counter()
+        self.tail_time = max(self.tail_time, end - tail_start)
+        self.latencies.append(end - start)
+        self.depths.append(searched)
+        return power
+
+    def run(self):
+        """
+        Drives the whole route, deciding every sub-segment online.
+
+        Returns:
+            ndarray: The output power applied on each sub-segment, the state lists of the simulation
+                     hold the trace.
+        """
+        sim = self.simulation
+        route = sim.route
+        sim.initialize_state_lists()
+        self.reset()
+        policy = np.zeros(len(route))
+        for k in range(len(route)):
+            policy[k] = self.decide(k)
+            sim.vehicle.output_power = policy[k]
+            new_velocity, new_energy, delta_t = sim.calculate_next_state(
+                float(route.angle_array[k]), policy[k], float(route.mu_array[k]),
+                (self.gravity_forces[k], self.friction_forces[k]), sim.step_distances[k])
+            sim.record_state(new_velocity, new_energy, delta_t, policy[k], sim.step_distances[k])
+        sim.policy = policy
+        return policy
+
+    def latency_stats(self):
+        """
+        Returns the decision latency statistics in seconds: 'p50', 'p99', 'max', 'mean', the number of
+        'decisions', of decisions 'over_budget' and the mean searched 'depth'.
+        """
+        if not self.latencies:
+            return {'p50': None, 'p99': None, 'max': None, 'mean': None, 'decisions': 0, 'over_budget': 0, 'depth': None}
+        latencies = np.array(self.latencies)
+        budget = np.inf if self.latency_budget is None else self.latency_budget
+        return {'p50': float(np.percentile(latencies, 50)),
+                'p99': float(np.percentile(latencies, 99)),
+                'max': float(latencies.max()),
+                'mean': float(latencies.mean()),
+                'decisions': len(latencies),
+                'over_budget': int((latencies > budget).sum()),
+                'depth': float(np.mean(self.depths))}
+
+
+if __name__ == "__main__":
+    import copy
+
+    from vehicle import Vehicle
+    from route import Route
+    from simulation_cp import Simulation
+
+    vehi = Vehicle(mass=18000, frontal_area=8.16, velocity_init=5, energy_left=15000, velocity_max=60, energy_max=15000)
+    rout = Route(((4, 5, 0.015), (2, -5, 0.015), (4, 5, 0.015)), delta_s=0.5)
+
+    controller = MPCController(Simulation(copy.deepcopy(vehi), rout, distance_step=0.5))
+    controller.run()
+    reference = Simulation(copy.deepcopy(vehi), rout, distance_step=0.5)
+    reference.dynamic_programming_approach()
+    gap = controller.simulation.time_list[-1] / reference.time_list[-1] - 1
+    print(f"Time: {controller.simulation.time_list[-1]}, {gap:.2%} slower than dynamic programming, "
+          f"latency: {controller.latency_stats()}")
@@ -0,0 +1,255 @@
+import numpy as np
+
+
+def _maximum(a, b):
+    # Builtin max on scalars, much faster than a ufunc in the step by step loops
+    return np.maximum(a, b) if isinstance(a, np.ndarray) else max(a, b)
+
+
+def _clip(value, low, high):
+    if isinstance(value, np.ndarray):
+        return np.maximum(np.minimum(value, high), low)
+    return max(min(value, high), low)
+
+
+def _square(velocity):
+    # float_power goes through libm pow like the scalar velocity ** 2, array ** 2 may differ by one ulp
+    return np.float_power(velocity, 2) if isinstance(velocity, np.ndarray) else velocity ** 2
+
+
+def describe_regeneration(regeneration):
+    """
+    JSON compatible description of a regeneration model, for the content addressed caches.
+
+    The model is described by its class name and the parameters returned by its describe()
+    method, None stands for the default LinearRegeneration(). A plain function, lambda or
+    partial cannot tell its parameters apart and raises a ValueError, so that two different
+    models never share a cache entry.
+    """
+    if regeneration is None:
+        regeneration = LinearRegeneration()
+    describe = getattr(regeneration, 'describe', None)
+    if describe is None:
+        raise ValueError("The regeneration model must have a describe() method returning its parameters "
+                         "to be cached.")
+    return {'model': type(regeneration).__qualname__, **describe()}
+
+
+class LinearRegeneration:
+    # Whether __call__ reads the resistance, the models leave it out of the hot loops when it does not
+    uses_resistance = False
+
+    def __init__(self, coefficient=0.740):
+        """
+        Energy flow proportional to the velocity, the historical -0.740 * v term of both simulators.
+
+        With the default positive coefficient the flow is a drain growing with the velocity,
+        whatever the power and the road.
+
+        Parameters:
+            coefficient (float): Energy drawn per unit of velocity and of step ratio.
+        """
+        self.coefficient = coefficient
+
+    def describe(self):
+        """Parameters of the model, as a JSON compatible dictionary."""
+        return {'coefficient': float(self.coefficient)}
+
+    def __call__(self, velocity, output_power, resistance):
+        return -self.coefficient * velocity
+
+
+class BrakingRegeneration(LinearRegeneration):
+    uses_resistance = True
+
+    def __init__(self, efficiency=0.6, coefficient=0.740):
+        """
+        LinearRegeneration plus the recovery of a share of the power the road gives back.
+
+        When the resisting forces are negative (a descent steeper than the friction and the drag),
+        efficiency times the power they deliver, -resistance * v, is recovered. The velocity
+        dynamics are left unchanged, the recovery only shows in the energy.
+
+        Parameters:
+            efficiency (float): Share of the power of the road recovered, between 0 and 1.
+            coefficient (float): The velocity proportional drain of LinearRegeneration.
+        """
+        if not (0 <= efficiency <= 1):
+            raise ValueError("Regeneration efficiency must be between 0 and 1.")
+        super().__init__(coefficient)
+        self.efficiency = efficiency
+
+    def describe(self):
+        return dict(super().describe(), efficiency=float(self.efficiency))
+
+    def __call__(self, velocity, output_power, resistance):
+        recovered = self.efficiency * _maximum(-resistance * velocity, 0.0)
+        return recovered - self.coefficient * velocity
+
+
+class PhysicsModel:
+    def __init__(self, mass, frontal_area, velocity_max, drag_coefficient=0.6, gravity=9.81, min_velocity=2,
+                 fixed_output_powers=(0, 9000, 60000), velocity_floor=5, velocity_scale=1000, time_scale=3600,
+                 grade_power_divisor=1000, absolute_grade_power=True, regeneration=None):
+        """
+        Longitudinal vehicle model shared by the simulators, the batch and compiled rollouts and the solvers.
+
+        One step of length ds from velocity v with output power P:
+            step_ratio = ds / max(v, velocity_floor)
+            a = (P / v - gravity_force - friction_force - C_d * A * v ** 2 / 2) / mass
+            v' = clip(v + a * step_ratio * velocity_scale, min_velocity, velocity_max)
+            E' = E - P * step_ratio + regeneration(v, P, resistance) * step_ratio
+            t' = t + step_ratio * time_scale
+        Every method takes Python floats or NumPy arrays of any broadcastable shapes.
+
+        simulation.Simulation and simulation_cp.Simulation have always used different units, kept
+        as parameters here: the first counts distances in km and time in hours, hence the 1000 and
+        3600 factors and the floor of 5 on the velocity, and records the grade holding power u4 as
+        |u4| / 1000. The second counts in SI units, floors the velocity at min_velocity, keeps the
+        sign of u4 and uses u3 = 150000. See simulation_model and simulation_cp_model.
+
+        Parameters:
+            mass, frontal_area, velocity_max (float): The vehicle fields.
+            drag_coefficient, gravity, min_velocity (float): The simulation constants.
+            fixed_output_powers (tuple): The candidates u1, u2, u3.
+            velocity_floor (float or None): Smallest velocity dividing the step, None uses min_velocity.
+            velocity_scale (float): Factor of the velocity increment.
+            time_scale (float): Factor of the time increment.
+            grade_power_divisor (float): Divisor of the grade holding candidate u4.
+            absolute_grade_power (bool): Whether u4 is taken in absolute value.
+            regeneration (callable): Energy flow per unit of step ratio, called as
+                                     regeneration(velocity, output_power, resistance) with
+                                     resistance the sum of the gravity, friction and drag forces,
+                                     None when its uses_resistance attribute is False.
+                                     Its describe() method, returning its parameters, is
+                                     needed by the caches of sweep.py and store.py.
+                                     Default is LinearRegeneration().
+        """
+        self.mass = mass
+        self.A = frontal_area
+        self.velocity_max = velocity_max
+        self.C_d = drag_coefficient
+        self.g = gravity
+        self.min_velocity = min_velocity
+        self.fixed_output_powers = tuple(fixed_output_powers)
+        self.velocity_floor = min_velocity if velocity_floor is None else velocity_floor
+        self.velocity_scale = velocity_scale
+        self.time_scale = time_scale
+        self.grade_power_divisor = grade_power_divisor
+        self.absolute_grade_power = absolute_grade_power
+        self.regeneration = LinearRegeneration() if regeneration is None else regeneration
+        self._uses_resistance = getattr(self.regeneration, 'uses_resistance', True)
+
+    @classmethod
+    def simulation_model(cls, vehicle, drag_coefficient=0.6, gravity=9.81, min_velocity=2, **kwargs):
+        """The model of simulation.Simulation for the given vehicle, kwargs override its parameters."""
+        return cls(vehicle.mass, vehicle.frontal_area, vehicle.velocity_max, drag_coefficient, gravity, min_velocity,
+                   **kwargs)
+
+    @classmethod
+    def simulation_cp_model(cls, vehicle, drag_coefficient=0.6, gravity=9.81, min_velocity=2, **kwargs):
+        """The model of simulation_cp.Simulation for the given vehicle, kwargs override its parameters."""
+        parameters = dict(fixed_output_powers=(0, 9000, 150000), velocity_floor=None, velocity_scale=1, time_scale=1,
+                          grade_power_divisor=1, absolute_grade_power=False)
+        parameters.update(kwargs)
+        return cls(vehicle.mass, vehicle.frontal_area, vehicle.velocity_max, drag_coefficient, gravity, min_velocity,
+                   **parameters)
+
+    @staticmethod
+    def square(velocity):
+        """velocity ** 2, with the same bits for a float and for the elements of an array."""
+        return _square(velocity)
+
+    def road_forces(self, incline_angle, mu):
+        """Gravity and friction forces on an incline given in degrees."""
+        rad_angle = np.radians(incline_angle)
+        return self.mass * self.g * np.sin(rad_angle), self.mass * self.g * np.cos(rad_angle) * mu
+
+    def grade_power(self, velocity, sin_angle, cos_angle, mu, velocity_squared=None):
+        """
+        The candidate u4, the power holding the velocity against the grade and friction.
+
+        velocity_squared optionally gives velocity ** 2 computed once for grade_power and transition.
+        """
+        if velocity_squared is None:
+            velocity_squared = _square(velocity)
+        power = self.mass * self.g * velocity * (sin_angle + mu * cos_angle) - self.C_d * self.A * velocity_squared / 21.15
+        if self.absolute_grade_power:
+            power = abs(power)
+        return power / self.grade_power_divisor
+
+    def candidate_powers(self, velocity, sin_angle, cos_angle, mu):
+        """
+        The candidates u1..u4 at each velocity.
+
+        Returns:
+            ndarray: Shape (4,) + velocity.shape.
+        """
+        velocity = np.asarray(velocity, dtype=float)
+        powers = np.empty((4,) + velocity.shape)
+        powers[0], powers[1], powers[2] = self.fixed_output_powers
+        powers[3] = self.grade_power(velocity, sin_angle, cos_angle, mu)
+        return powers
+
+    def transition(self, velocity, output_power, gravity_force, friction_force, distance_step, velocity_squared=None):
+        """
+        One step of the model, independent of the energy left, velocity_squared as in grade_power.
+
+        Returns:
+            tuple: (new_velocity, power_consumed, power_regenerated, delta_t), the energy decreases
+                   by power_consumed and increases by power_regenerated.
+        """
+        if velocity_squared is None:
+            velocity_squared = _square(velocity)
+        drag_force = self.C_d * self.A * velocity_squared / 2
+        total_force = output_power / velocity - gravity_force - friction_force - drag_force
+        acceleration = total_force / self.mass
+
+        step_ratio = distance_step / _maximum(velocity, self.velocity_floor)
+        new_velocity = _clip(velocity + acceleration * step_ratio * self.velocity_scale, self.min_velocity,
+                             self.velocity_max)
+        power_consumed = output_power * step_ratio
+        resistance = gravity_force + friction_force + drag_force if self._uses_resistance else None
+        power_regenerated = self.regeneration(velocity, output_power, resistance) * step_ratio
+        delta_t = step_ratio * self.time_scale
+        return new_velocity, power_consumed, power_regenerated, delta_t
+
+    @staticmethod
+    def energy_transition(energy, step, clamp_energy=True):
+        """Completes a transition from the given energy, returns (new_velocity, new_energy, delta_t)."""
+        new_velocity, power_consumed, power_regenerated, delta_t = step
+        new_energy = energy - power_consumed + power_regenerated
+        if clamp_energy:
+            new_energy = _maximum(new_energy, 0)
+        return new_velocity, new_energy, delta_t
+
+    def rates(self, velocity, output_power, gravity_force, friction_force):
+        """
+        Derivatives in distance of (velocity, energy, time) of the transition, without the velocity clamp.
+
+        Returns:
+            tuple: (dv/ds, dE/ds, dt/ds)
+        """
+        drag_force = self.C_d * self.A * _square(velocity) / 2
+        acceleration = (output_power / velocity - gravity_force - friction_force - drag_force) / self.mass
+        step_ratio = 1 / _maximum(velocity, self.velocity_floor)
+        resistance = gravity_force + friction_force + drag_force if self._uses_resistance else None
+        regenerated = self.regeneration(velocity, output_power, resistance)
+        return (acceleration * step_ratio * self.velocity_scale, -(output_power - regenerated) * step_ratio,
+                self.time_scale * step_ratio)
+
+    def kernel_parameters(self):
+        """
+        Parameters of kernels._rollout.
+
+        Returns:
+            ndarray: mass, g, C_d, A, velocity_max, min_velocity, u1, u2, u3, velocity_floor,
+                     velocity_scale, time_scale, grade_power_divisor, absolute_grade_power and
+                     the regeneration coefficient.
+        """
+        if type(self.regeneration) is not LinearRegeneration:
+            raise ValueError("The compiled kernels only support LinearRegeneration.")
+        return np.array([self.mass, self.g, self.C_d, self.A, self.velocity_max, self.min_velocity]
+                        + list(self.fixed_output_powers)
+                        + [self.velocity_floor, self.velocity_scale, self.time_scale, self.grade_power_divisor,
+                           float(self.absolute_grade_power), self.regeneration.coefficient], dtype=float)
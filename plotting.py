@@ -0,0 +1,110 @@
+import numpy as np
+
+# Labels of the panels of plot_trajectory: (trace, legend, y axis) for time, output power, velocity and energy
+PANELS = (('time', 'Time (s)', 'Time (s)'),
+          ('output_power', 'Power Output (kW)', 'Power Output (kW)'),
+          ('velocity', 'Velocity (km/h)', 'Velocity (km/h)'),
+          ('energy', 'Energy (kJ)', 'Energy (kJ)'))
+FIELDS = ('time', 'distance', 'velocity', 'energy', 'output_power')
+
+
+def decimate(x, y, n_bins):
+    """
+    Min/max decimation of a trace for display.
+
+    The points are split into n_bins consecutive bins and each bin is replaced by its minimum
+    and maximum, in their original order, so that the drawn envelope keeps every peak and every
+    step of the trace. The first and last points are always kept.
+
+    Parameters:
+        x (ndarray): Abscissae, increasing.
+        y (ndarray): Values at x.
+        n_bins (int): Number of bins, about the width of the plot in pixels.
+
+    Returns:
+        tuple: (x, y) of at most 2 * n_bins + 2 points, the input itself when it is not longer.
+    """
+    if n_bins < 1:
+        raise ValueError("Number of bins must be positive.")
+    x = np.asarray(x, dtype=float)
+    y = np.asarray(y, dtype=float)
+    if len(y) <= 2 * n_bins + 2:
+        return x, y
+
+    # Interior points by bin, sorted by value within each bin: the extrema start and end the bins
+    interior = len(y) - 2
+    bin_of = np.arange(interior) * n_bins // interior
+    order = np.lexsort((y[1:-1], bin_of))
+    starts = np.searchsorted(bin_of, np.arange(n_bins))
+    ends = np.append(starts[1:], interior) - 1
+    extrema = np.sort(np.stack([order[starts], order[ends]]), axis=0).T.ravel() + 1
+
+    index = np.concatenate([[0], extrema, [len(y) - 1]])
+    return x[index], y[index]
+
+
+def plot_trajectory(traces, path=None, panels=PANELS, distance_label='Distance (km)', width=1200, height=800,
+                    dpi=100, show=True):
+    """
+    Plots the time, output power, velocity and energy of a run against the distance.
+
+    matplotlib is only imported here, so that batch runs never load it. Every trace is reduced
+    by decimate to about two points per pixel column, so the cost does not grow with the number
+    of steps. The output power, constant over each sub-segment, is drawn as steps. With a path,
+    the figure is rendered straight to the file without pyplot, which needs no display.
+
+    Parameters:
+        traces (Trajectory or ndarray): The record of a run, or its (5, steps) arrays in the
+                                        order of Trajectory.fields.
+        path (str or None): File to render to, its extension gives the format (png, pdf, svg...).
+        panels (tuple): (trace, legend, y axis label) of each panel, from top to bottom.
+        distance_label (str): Label of the distance axes.
+        width, height (int): Size of the figure in pixels.
+        dpi (int): Pixels per inch of the figure.
+        show (bool): Show the figure with pyplot when no path is given.
+
+    Returns:
+        matplotlib.figure.Figure: The figure.
+    """
+    arrays = traces.arrays() if hasattr(traces, 'arrays') else np.asarray(traces, dtype=float)
+    if arrays.ndim != 2 or arrays.shape[0] != len(FIELDS):
+        raise ValueError("Traces must have one row per field of Trajectory.")
+
+    if path is None:
+        import matplotlib.pyplot as plt
+        figure = plt.figure(figsize=(width / dpi, height / dpi), dpi=dpi)
+    else:
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        figure = Figure(figsize=(width / dpi, height / dpi), dpi=dpi)
+        FigureCanvasAgg(figure)
+
+    distance = arrays[FIELDS.index('distance')]
+    for i, (field, legend, label) in enumerate(panels):
+        axes = figure.add_subplot(len(panels), 1, i + 1)
+        x, y = decimate(distance, arrays[FIELDS.index(field)], width)
+        if field == 'output_power':
+            axes.step(x, y, where='pre', label=legend)
+        else:
+            axes.plot(x, y, label=legend)
+        axes.set_xlabel(distance_label)
+        axes.set_ylabel(label)
+        axes.legend()
+    figure.tight_layout()
+
+    if path is not None:
+        figure.savefig(path)
+    elif show:
+        plt.show()
+    return figure
+
+
+if __name__ == "__main__":
+    import time
+
+    distance = np.linspace(0, 200, 200001)
+    velocity = 40 + 10 * np.sin(distance) + np.random.default_rng(0).normal(0, 1, len(distance))
+    traces = np.array([distance * 90, distance, velocity, 15000 - 70 * distance, 60 * (velocity > 45)])
+    start = time.perf_counter()
+    plot_trajectory(traces, path='trajectory.png')
+    print(f"{traces.shape[1]} points rendered in {time.perf_counter() - start:.3f} s")
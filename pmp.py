@@ -0,0 +1,237 @@
+import copy
+import time
+
+import numpy as np
+
+from simulation import Simulation
+
+
+class PMPSolver:
+    def __init__(self, vehicle, route, distance_step=1, drag_coefficient=0.6, efficiency=0.86, gravity=9.81,
+                 min_velocity=2, regeneration=None, velocity_bins=401, tolerance=1e-3, max_iterations=60,
+                 needle_passes=10, needle_window=4, batch_size=4096):
+        """
+        Minimum time power schedule from the (discrete) Pontryagin Minimum Principle, solved by shooting.
+
+        The state of simulation.Simulation after sub-segment k is x_k = (v_k, E_k) and the cost is
+        the time sum of dt_k. The energy must last over the route (simulate stops under 2),
+        which gives the constant energy costate lambda_E >= 0. The control u_k minimizes the
+        Hamiltonian over the candidates u1..u4 of calculate_possible_output_power_value,
+            H_k = dt_k(v_k) - lambda_E * dE_k(v_k, u) + V_{k+1}(v_{k+1}(v_k, u)),
+        where V_k is the time to go as a function of the velocity for this lambda_E. The velocity
+        costate lambda_k is the gradient of V_k. Rather than propagating lambda_k backward from
+        lambda_N = 0 by its adjoint equation, V_k itself is propagated on a velocity grid. The
+        model is clamped and saturates within a step, so the local costate of the adjoint
+        equation leads the sweeps to poor extremals, while V_k keeps the global minimum over
+        the candidates at every velocity.
+
+        For a given lambda_E, the schedule is the forward minimization of H_k from the vehicle
+        state with the exact transitions. The shooting bisects lambda_E on the terminal energy
+        condition, for the smallest energy price whose schedule completes the route:
+        lambda_E = 0 when the energy never binds, otherwise a bracket is grown geometrically from
+        1e-6 and bisected. V_k ignores the energy and is interpolated, so the fastest complete
+        extremal is finally refined by needle variations (see _needle_variations). On the
+        reference courses this matches or beats one million random rollouts and the
+        cross-entropy search.
+
+        Parameters:
+            vehicle (Vehicle): Initial vehicle state, it is not modified.
+            route (Route): The route to drive, one control per sub-segment.
+            distance_step, drag_coefficient, efficiency, gravity, min_velocity, regeneration: As in Simulation.
+            velocity_bins (int): Number of velocity nodes of V_k between min_velocity and velocity_max.
+            tolerance (float): Relative width of the lambda_E bracket at which the shooting stops.
+            max_iterations (int): Maximum number of lambda_E evaluations.
+            needle_passes (int): Maximum number of needle variation passes.
+            needle_window (int): Sub-segments on each side of a control switch where needles are tried.
+            batch_size (int): Needle variations rolled out together.
+        """
+        if velocity_bins < 2:
+            raise ValueError("The velocity grid needs at least two nodes.")
+        if tolerance <= 0:
+            raise ValueError("Tolerance must be positive.")
+        if needle_passes < 0 or needle_window < 0:
+            raise ValueError("Needle passes and window must not be negative.")
+
+        self.vehicle = vehicle
+        self.route = route
+        self.simulation_kwargs = {'distance_step': distance_step, 'drag_coefficient': drag_coefficient,
+                                  'efficiency': efficiency, 'gravity': gravity, 'min_velocity': min_velocity,
+                                  'regeneration': regeneration}
+        self.simulation = Simulation(copy.deepcopy(vehicle), route, **self.simulation_kwargs)
+
+        self.velocity_grid = np.linspace(min_velocity, vehicle.velocity_max, velocity_bins)
+        self.tolerance = tolerance
+        self.max_iterations = max_iterations
+        self.needle_passes = needle_passes
+        self.needle_window = needle_window
+        self.batch_size = batch_size
+        self.iterations = 0
+        self.n_rollouts = 0
+        self._grid_steps = None
+
+    def _road(self, k):
+        sim = self.simulation
+        gravity_forces, friction_forces = self.route.road_forces(self.vehicle.mass, sim.g)
+        return (self.route.sin_array[k], self.route.cos_array[k], self.route.mu_array[k],
+                gravity_forces[k], friction_forces[k], sim.step_distances[k])
+
+    def _step(self, velocity, road):
+        """Transitions of the four candidates: new velocities, energy increments and time increment."""
+        physics = self.simulation.physics
+        sin_angle, cos_angle, mu, gravity_force, friction_force, distance_step = road
+        powers = physics.candidate_powers(velocity, sin_angle, cos_angle, mu)
+        new_velocity, power_consumed, power_regenerated, delta_t = physics.transition(
+            velocity, powers, gravity_force, friction_force, distance_step)
+        return new_velocity, power_regenerated - power_consumed, delta_t
+
+    def _grid_transitions(self):
+        """_step on the velocity grid for every sub-segment, shared by the sub-segments of a class."""
+        if self._grid_steps is None:
+            classes = {}
+            self._grid_steps = []
+            for k in range(len(self.route)):
+                road = self._road(k)
+                key = tuple(float(value) for value in road)
+                if key not in classes:
+                    classes[key] = self._step(self.velocity_grid, road)
+                self._grid_steps.append(classes[key])
+        return self._grid_steps
+
+    def _time_to_go(self, lambda_e):
+        """V_k on the velocity grid for k = 0..N, shape (N + 1, velocity_bins)."""
+        steps = self._grid_transitions()
+        V = np.zeros((len(steps) + 1, len(self.velocity_grid)))
+        for k in range(len(steps) - 1, -1, -1):
+            new_velocity, delta_energy, delta_t = steps[k]
+            hamiltonian = delta_t - lambda_e * delta_energy + np.interp(new_velocity, self.velocity_grid, V[k + 1])
+            V[k] = hamiltonian.min(axis=0)
+        return V
+
+    def _schedule(self, lambda_e):
+        """Forward minimization of the Hamiltonian from the vehicle state, returns the candidate indices."""
+        V = self._time_to_go(lambda_e)
+        n_steps = len(self.route)
+        choices = np.zeros(n_steps, dtype=np.int8)
+        velocity = float(self.vehicle.velocity)
+        for k in range(n_steps):
+            new_velocity, delta_energy, delta_t = self._step(velocity, self._road(k))
+            hamiltonian = delta_t - lambda_e * delta_energy + np.interp(new_velocity, self.velocity_grid, V[k + 1])
+            choices[k] = np.argmin(hamiltonian)
+            velocity = float(new_velocity[choices[k]])
+        return choices
+
+    def _evaluate(self, choices):
+        """Times of schedules in Simulation, inf when the energy runs out before the end."""
+        choices = np.atleast_2d(choices)
+        self.n_rollouts += len(choices)
+        result = self.simulation._batch_rollout(choices)
+        return np.where(result['steps'] == len(self.route), result['time'], np.inf)
+
+    def _needle_variations(self, choices, schedule_time):
+        """
+        Improves a schedule by needle variations, for at most needle_passes passes.
+
+        A needle variation changes the control of a single sub-segment. The grid error of V_k
+        shows where the extremal switches control, so the needles are only tried within
+        needle_window sub-segments of a switch or of the ends of the route, which keeps a pass
+        linear in the number of switches rather than quadratic in the route length. Each pass
+        rolls them out by batches of batch_size and the fastest replaces the schedule.
+        """
+        n_steps = len(choices)
+        offsets = np.arange(-self.needle_window, self.needle_window + 1)
+        for _ in range(self.needle_passes):
+            switches = np.concatenate([[0], np.flatnonzero(np.diff(choices)) + 1, [n_steps - 1]])
+            positions = np.unique(np.clip((switches[:, None] + offsets).ravel(), 0, n_steps - 1))
+            # The three other controls at each position
+            controls = ((choices[positions, None] + np.arange(1, 4)) % 4).ravel()
+            positions = np.repeat(positions, 3)
+            best_time, best_variation = schedule_time, None
+            for start in range(0, len(positions), self.batch_size):
+                rows = slice(start, start + self.batch_size)
+                variations = np.repeat(choices[None, :], len(positions[rows]), axis=0)
+                variations[np.arange(len(variations)), positions[rows]] = controls[rows]
+                times = self._evaluate(variations)
+                i = int(np.argmin(times))
+                if times[i] < best_time:
+                    best_time, best_variation = float(times[i]), variations[i]
+            if best_variation is None:
+                break
+            choices, schedule_time = best_variation, best_time
+        return choices, schedule_time
+
+    def solve(self, initial_choices=None):
+        """
+        Solves the boundary value problem and replays the schedule in Simulation.
+
+        Parameters:
+            initial_choices (ndarray of int): Optional schedule to warm-start from, e.g. a cached
+                                              solution, kept if no extremal beats it.
+
+        Returns:
+            dict: 'time' of the schedule in Simulation (inf if the energy always runs out), its
+                  'choices' and 'output_power', the energy costate 'lambda_energy', the
+                  number of shooting 'iterations', the 'n_rollouts' of Simulation it took,
+                  needle variations included, the 'wall_time' and the 'simulation' holding
+                  the trace.
+        """
+        start = time.perf_counter()
+        self.iterations = 0
+        self.n_rollouts = 0
+        best = {'time': np.inf, 'choices': None, 'lambda_energy': None}
+
+        def shoot(lambda_e):
+            self.iterations += 1
+            choices = self._schedule(lambda_e)
+            schedule_time = float(self._evaluate(choices)[0])
+            if schedule_time < best['time']:
+                best.update(time=schedule_time, choices=choices, lambda_energy=float(lambda_e))
+            return np.isfinite(schedule_time)
+
+        if initial_choices is not None:
+            initial_choices = np.asarray(initial_choices, dtype=np.int8)
+            best.update(time=float(self._evaluate(initial_choices)[0]), choices=initial_choices)
+
+        # Bracket the smallest energy price that completes the route, then bisect it
+        low, high = 0.0, None
+        if not shoot(0.0):
+            candidate = 1e-6
+            while self.iterations < self.max_iterations:
+                if shoot(candidate):
+                    high = candidate
+                    break
+                low, candidate = candidate, candidate * 10
+        while high is not None and high - low > self.tolerance * high and self.iterations < self.max_iterations:
+            middle = np.sqrt(low * high) if low > 0 else high / 10
+            if shoot(middle):
+                high = middle
+            else:
+                low = middle
+        if np.isfinite(best['time']):
+            best['choices'], best['time'] = self._needle_variations(best['choices'], best['time'])
+
+        self.simulation = Simulation(copy.deepcopy(self.vehicle), self.route, **self.simulation_kwargs)
+        output_power = None
+        if best['choices'] is not None and np.isfinite(best['time']):
+            self.simulation.simulate_batch(1, choices=best['choices'][None, :])
+            output_power = np.array(self.simulation.output_power_list[1:]) * 1000
+
+        return {'time': best['time'],
+                'choices': best['choices'],
+                'output_power': output_power,
+                'lambda_energy': best['lambda_energy'],
+                'iterations': self.iterations,
+                'n_rollouts': self.n_rollouts,
+                'wall_time': time.perf_counter() - start,
+                'simulation': self.simulation}
+
+
+if __name__ == "__main__":
+    from vehicle import Vehicle
+    from route import Route
+
+    vehi = Vehicle(mass=18000, frontal_area=8.16, velocity_init=5, energy_left=15000, velocity_max=60, energy_max=15000)
+    rout = Route(((4, 5, 0.015), (2, -5, 0.015), (4, 5, 0.015)), delta_s=0.5)
+
+    result = PMPSolver(vehi, rout, distance_step=0.5).solve()
+    print(f"Time: {result['time']} s after {result['iterations']} shooting iterations and {result['n_rollouts']} "
+          f"rollouts in {result['wall_time']:.3f} s")
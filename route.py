@@ -1,35 +1,173 @@
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+
 class Route:
+    # Number of (mass, g) keys whose road forces are kept, a sweep over masses only keeps the latest ones
+    road_forces_maxsize = 4
+
     def __init__(self, segments, delta_s=10):
         """
         Initializes a new Route instance.
 
         Parameters:
-            segments (list of tuples): Each tuple contains information about a segment
+            segments (list of tuples or ndarray): Each tuple contains information about a segment
                                        in the form (segment_distance, segment_inclination_angle, mu).
-            delta_s (float): Distance interval to store information, default is 10 meters.
+            delta_s (float or sequence of float): Distance interval to store information, default is 10 meters.
+                                       A sequence gives one interval per segment.
+
+        Each segment is cut into sub-segments of delta_s meters, the remainder of a segment
+        that is not a multiple of delta_s gives a final shorter sub-segment.
         """
         self.segments = segments
-        self.inclination_angle_list = []
-        self.distance_list = []
-        self.mu_list = []
-        self.road_info_list = []  # List to store road information for each 10m segment
         self.delta_s = delta_s
-        
-        cumulative_distance = 0
-        for segment in segments:
-            segment_distance, segment_inclination_angle, mu = segment
-            self.inclination_angle_list.append(segment_inclination_angle)
-            self.mu_list.append(mu)
-            
-            num_subsegments = int(segment_distance / delta_s)
-            remaining_distance = segment_distance
-            for _ in range(num_subsegments):
-                current_segment_distance = min(remaining_distance, delta_s)
-                self.road_info_list.append((cumulative_distance + current_segment_distance, segment_inclination_angle, mu))
-                remaining_distance -= current_segment_distance
-                cumulative_distance += current_segment_distance
 
+        segment_array = np.asarray(segments, dtype=float).reshape(-1, 3)
         self.distance_list = [segment[0] for segment in segments]
+        self.inclination_angle_list = [segment[1] for segment in segments]
+        self.mu_list = [segment[2] for segment in segments]
+
+        delta_array = np.broadcast_to(np.asarray(delta_s, dtype=float), (len(segment_array),))
+        if np.any(delta_array <= 0):
+            raise ValueError("Distance interval must be positive.")
+        self._discretize(segment_array[:, 0], segment_array[:, 1], segment_array[:, 2], delta_array)
+
+        # Per sub-segment trigonometry, road forces and tuples, built on first use
+        self._trig = None
+        self._road_forces = OrderedDict()
+        self._road_info_list = None
+
+    def _discretize(self, lengths, angles, mus, deltas):
+        """Cuts the segments into sub-segments, stored as NumPy columns."""
+        # Full sub-segments of each segment, with a tolerance for lengths like 0.3 / 0.1
+        full_counts = np.floor(lengths / deltas + 1e-9).astype(np.int64)
+        remainders = lengths - full_counts * deltas
+        has_partial = remainders > 1e-9 * deltas
+        counts = full_counts + has_partial
+
+        segment_index = np.repeat(np.arange(len(lengths)), counts)
+        steps = deltas[segment_index]
+        steps[(np.cumsum(counts) - 1)[has_partial]] = remainders[has_partial]
+
+        self.segment_index_array = segment_index
+        self.step_array = steps
+        self.nominal_step_array = deltas[segment_index]
+        self.distance_array = np.cumsum(steps)
+        self.angle_array = angles[segment_index]
+        self.mu_array = mus[segment_index]
+
+    @classmethod
+    def from_profile(cls, distance, altitude, mu=0.015, delta_s=10):
+        """
+        Builds a route from an elevation profile.
+
+        Parameters:
+            distance (array-like): Increasing distances along the road of the profile points, in meters.
+            altitude (array-like): Altitude of each point in meters.
+            mu (float or array-like): Friction coefficient, one value or one per profile interval.
+            delta_s (float): Distance interval of the sub-segments.
+
+        Returns:
+            Route: One segment per profile interval, its angle given by the altitude change along the road.
+        """
+        distance = np.asarray(distance, dtype=float)
+        altitude = np.asarray(altitude, dtype=float)
+        if distance.shape != altitude.shape or distance.ndim != 1 or len(distance) < 2:
+            raise ValueError("The profile needs at least two points of distance and altitude.")
+        lengths = np.diff(distance)
+        if np.any(lengths <= 0):
+            raise ValueError("Profile distances must be increasing.")
+
+        angles = np.degrees(np.arcsin(np.clip(np.diff(altitude) / lengths, -1, 1)))
+        segments = np.column_stack([lengths, angles, np.broadcast_to(np.asarray(mu, dtype=float), lengths.shape)])
+        return cls(segments, delta_s=delta_s)
+
+    @classmethod
+    def from_file(cls, path, mu=0.015, delta_s=10):
+        """
+        Builds a route from an elevation profile stored in a .npy or .csv file.
+
+        The file holds one row per profile point: distance, altitude and optionally the friction
+        coefficient of the interval starting at that point. A header line in a CSV file is skipped.
+
+        Parameters:
+            path (str): Path of the .npy or .csv file.
+            mu (float): Friction coefficient used when the file has no third column.
+            delta_s (float): Distance interval of the sub-segments.
+        """
+        if os.path.splitext(path)[1] == '.npy':
+            profile = np.load(path)
+        else:
+            try:
+                profile = np.loadtxt(path, delimiter=',', ndmin=2)
+            except ValueError:
+                profile = np.loadtxt(path, delimiter=',', ndmin=2, skiprows=1)
+        if profile.ndim != 2 or profile.shape[1] not in (2, 3):
+            raise ValueError("The profile must have two or three columns: distance, altitude and mu.")
+        if profile.shape[1] == 3:
+            mu = profile[:-1, 2]
+        return cls.from_profile(profile[:, 0], profile[:, 1], mu=mu, delta_s=delta_s)
+
+    @property
+    def road_info_list(self):
+        """List of (cumulative distance, inclination angle, mu) for each sub-segment."""
+        if self._road_info_list is None:
+            self._road_info_list = list(zip(self.distance_array.tolist(), self.angle_array.tolist(), self.mu_array.tolist()))
+        return self._road_info_list
+
+    def _get_trig(self):
+        if self._trig is None:
+            rad_angle = np.radians(self.angle_array)
+            self._trig = (np.sin(rad_angle), np.cos(rad_angle))
+        return self._trig
+
+    @property
+    def sin_array(self):
+        """Sine of the inclination angle of each sub-segment."""
+        return self._get_trig()[0]
+
+    @property
+    def cos_array(self):
+        """Cosine of the inclination angle of each sub-segment."""
+        return self._get_trig()[1]
+
+    def road_forces(self, mass, g):
+        """
+        Returns the grade and rolling resistance forces on each sub-segment, memoized by (mass, g).
+
+        Only the road_forces_maxsize most recently used keys are kept.
+
+        Parameters:
+            mass (float): Mass of the vehicle in kilograms.
+            g (float): Acceleration due to gravity in m/s^2.
+
+        Returns:
+            tuple of ndarray: (gravity_force, friction_force), i.e. mass * g * sin(angle) and
+                              mass * g * cos(angle) * mu, the terms of the simulators.
+        """
+        key = (mass, g)
+        if key in self._road_forces:
+            self._road_forces.move_to_end(key)
+        else:
+            self._road_forces[key] = (mass * g * self.sin_array, mass * g * self.cos_array * self.mu_array)
+            if len(self._road_forces) > self.road_forces_maxsize:
+                self._road_forces.popitem(last=False)
+        return self._road_forces[key]
+
+    def step_distances(self, distance_step=None):
+        """
+        Returns the distance travelled on each sub-segment by a simulation.
+
+        Parameters:
+            distance_step (float or None): Distance step of the simulation for a full sub-segment,
+                                           partial sub-segments get their share of it. With None the
+                                           sub-segment lengths of the route are used.
+        """
+        if distance_step is None:
+            return self.step_array
+        return distance_step * (self.step_array / self.nominal_step_array)
 
     def total_distance(self):
         """Returns the total distance of the route."""
@@ -39,6 +177,10 @@ class Route:
         """Returns the maximum inclination angle in the route."""
         return max(self.inclination_angle_list)
 
+    def __len__(self):
+        """Returns the number of sub-segments."""
+        return len(self.step_array)
+
     def __str__(self):
         route_info = "------------------ Input Route Info ------------------\n"
         for i, (distance, inclination, mu) in enumerate(self.road_info_list):
@@ -0,0 +1,279 @@
+import copy
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+
+from physics import describe_regeneration
+from simulation import Simulation
+
+
+def _search_shard(vehicle, route, n_rollouts, seed_sequence, batch_size, simulation_kwargs):
+    """
+    Runs the random search of one shard and returns its best-so-far record.
+
+    The record only holds scalars and the candidate indices of the best rollout, so that
+    sending it back to the parent process stays cheap whatever the number of rollouts.
+    """
+    rng = np.random.default_rng(seed_sequence)
+    sim = Simulation(copy.deepcopy(vehicle), route, rng=rng, **simulation_kwargs)
+    best = sim.simulate_batch(n_rollouts, batch_size=batch_size, rng=rng)
+    return {'time': best['time'],
+            'choices': best['choices'],
+            'n_complete': best['n_complete'],
+            'n_rollouts': n_rollouts}
+
+
+def _search_digest(vehicle, route, batch_size, simulation_kwargs):
+    """Hash of the problem a checkpoint of parallel_random_search was written for."""
+    simulation_kwargs = dict(simulation_kwargs)
+    if 'regeneration' in simulation_kwargs:
+        simulation_kwargs['regeneration'] = describe_regeneration(simulation_kwargs['regeneration'])
+    content = {'segments': np.asarray(route.segments, dtype=float).tolist(),
+               'delta_s': np.asarray(route.delta_s, dtype=float).tolist(),
+               'vehicle': {name: float(value) for name, value in vars(vehicle).items()},
+               'batch_size': batch_size,
+               'simulation': simulation_kwargs}
+    # Other objects (caches, instrumentation) do not change the result, only their type is kept
+    return hashlib.sha256(json.dumps(content, sort_keys=True,
+                                     default=lambda value: type(value).__qualname__).encode()).hexdigest()
+
+
+def _load_checkpoint(path):
+    """Reads a checkpoint of parallel_random_search, None if there is none yet."""
+    if path is None or not os.path.exists(path):
+        return None
+    with open(path) as f:
+        checkpoint = json.load(f)
+    for record in checkpoint['records'].values():
+        if record['choices'] is not None:
+            record['choices'] = np.array(record['choices'], dtype=np.int8)
+    checkpoint['records'] = {int(shard): record for shard, record in checkpoint['records'].items()}
+    return checkpoint
+
+
+def _save_checkpoint(path, checkpoint):
+    """Writes the checkpoint atomically, a crash while writing keeps the previous one."""
+    records = {str(shard): dict(record, choices=None if record['choices'] is None else record['choices'].tolist())
+               for shard, record in checkpoint['records'].items()}
+    temporary = path + '.tmp'
+    with open(temporary, 'w') as f:
+        json.dump(dict(checkpoint, records=records), f)
+    os.replace(temporary, path)
+
+
+def parallel_random_search(vehicle, route, n_rollouts, seed=None, n_workers=None, n_shards=64,
+                           batch_size=100000, checkpoint=None, **simulation_kwargs):
+    """
+    Monte Carlo search over power sequences, sharded across a pool of worker processes.
+
+    The rollouts are split into n_shards shards, each drawing its choices from its own
+    np.random.Generator spawned from a SeedSequence of the master seed. The result therefore
+    only depends on seed, n_rollouts and n_shards, not on the number of workers nor on the
+    order in which the shards finish.
+
+    Parameters:
+        vehicle (Vehicle): Initial vehicle state, copied for every shard.
+        route (Route): The route to drive.
+        n_rollouts (int): Total number of rollouts over all shards.
+        seed (int or None): Master seed, None draws a fresh one from the OS.
+        n_workers (int or None): Number of processes, default is the number of cores. With 1
+                                 the shards run in the current process.
+        n_shards (int): Number of independent shards, should be at least n_workers.
+        batch_size (int): Rollouts evaluated together inside a shard.
+        checkpoint (str or None): JSON file where the record of every finished shard is saved. If it
+                                  exists, the search resumes: its seed is reused and only the missing
+                                  shards run, which gives the result of an uninterrupted search. A
+                                  checkpoint written for another route, vehicle, batch_size or
+                                  simulation_kwargs raises a ValueError.
+        **simulation_kwargs: Extra arguments of Simulation (distance_step, drag_coefficient, ...).
+
+    Returns:
+        dict: 'time', 'choices' and 'shard' of the best complete rollout, 'n_complete',
+              'n_rollouts', 'seed', 'wall_time' and 'simulation', a Simulation holding the
+              trace of the best rollout.
+    """
+    if n_rollouts <= 0:
+        raise ValueError("Number of rollouts must be positive.")
+    if n_shards <= 0:
+        raise ValueError("Number of shards must be positive.")
+
+    saved = _load_checkpoint(checkpoint)
+    digest = None if checkpoint is None else _search_digest(vehicle, route, batch_size, simulation_kwargs)
+    if saved is not None:
+        if (saved['n_rollouts'], saved['n_shards']) != (n_rollouts, n_shards):
+            raise ValueError("The checkpoint was written by a search with other n_rollouts or n_shards.")
+        if saved.get('digest') != digest:
+            raise ValueError("The checkpoint was written by a search of another route, vehicle or simulation.")
+        if seed is not None and np.random.SeedSequence(seed).entropy != saved['seed']:
+            raise ValueError("The checkpoint was written by a search with another seed.")
+        seed = saved['seed']
+    seed_sequence = np.random.SeedSequence(seed)
+    if saved is None:
+        saved = {'seed': seed_sequence.entropy, 'n_rollouts': n_rollouts, 'n_shards': n_shards, 'digest': digest,
+                 'records': {}}
+
+    shard_sizes = [n_rollouts // n_shards + (i < n_rollouts % n_shards) for i in range(n_shards)]
+    tasks = {shard: (vehicle, route, size, child, batch_size, simulation_kwargs)
+             for shard, (size, child) in enumerate(zip(shard_sizes, seed_sequence.spawn(n_shards)))
+             if size > 0 and shard not in saved['records']}
+
+    def finish(shard, record):
+        saved['records'][shard] = record
+        if checkpoint is not None:
+            _save_checkpoint(checkpoint, saved)
+
+    start = time.perf_counter()
+    if n_workers == 1:
+        for shard, task in tasks.items():
+            finish(shard, _search_shard(*task))
+    elif tasks:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            futures = {executor.submit(_search_shard, *task): shard for shard, task in tasks.items()}
+            for future in as_completed(futures):
+                finish(futures[future], future.result())
+    wall_time = time.perf_counter() - start
+
+    # Ties are broken by the shard index
+    records = saved['records']
+    best_shard = min(sorted(records), key=lambda i: records[i]['time'])
+    best = records[best_shard]
+
+    sim = Simulation(copy.deepcopy(vehicle), route, **simulation_kwargs)
+    if best['choices'] is not None:
+        sim.simulate_batch(1, choices=best['choices'][None, :])
+
+    return {'time': best['time'],
+            'choices': best['choices'],
+            'shard': best_shard,
+            'n_complete': sum(record['n_complete'] for record in records.values()),
+            'n_rollouts': n_rollouts,
+            'seed': seed_sequence.entropy,
+            'wall_time': wall_time,
+            'simulation': sim}
+
+
+def cross_entropy_search(vehicle, route, population=200, elite_fraction=0.1, smoothing=0.7, max_generations=200,
+                         patience=20, tolerance=1e-3, seed=None, initial_choices=None, initial_weight=0.5,
+                         **simulation_kwargs):
+    """
+    Cross-entropy search over power sequences.
+
+    Keeps a categorical distribution over the four candidates of calculate_possible_output_power_value
+    on each sub-segment, starting from the uniform choice of power_strategy. Every generation draws a
+    population of schedules from it, evaluates them as one batch and moves the distribution toward
+    the frequencies of the elite rollouts. Rollouts covering the whole route rank by time, the other
+    ones after them by covered sub-segments, so that the search is driven toward complete schedules
+    even when none is found at first. Each sub-segment is fitted to the elite rollouts that drove
+    it, the sub-segments no elite reached to the elite frequencies pooled over the route.
+
+    Parameters:
+        vehicle (Vehicle): Initial vehicle state, it is not modified.
+        route (Route): The route to drive.
+        population (int): Rollouts per generation.
+        elite_fraction (float): Fraction of the population the distribution is fitted to.
+        smoothing (float): Weight of the elite frequencies in the update, 1 replaces the distribution.
+        max_generations (int): Maximum number of generations.
+        patience (int): Stops when the best time has not improved by more than tolerance for this many generations.
+        tolerance (float): Relative improvement of the best time below which a generation does not count.
+        seed (int or None): Seed of the sampling.
+        initial_choices (ndarray of int): Optional schedule to warm-start from, e.g. a cached solution.
+                                          It is part of the first generation and the initial
+                                          distribution leans toward it.
+        initial_weight (float): Probability mass put on initial_choices in the initial distribution.
+        **simulation_kwargs: Extra arguments of Simulation (distance_step, drag_coefficient, ...).
+
+    Returns:
+        dict: 'time' and 'choices' of the best complete rollout (inf and None if none), 'curve', the
+              best time after each generation, 'elite_time', the worst elite time of each generation,
+              'generations', 'n_rollouts', 'converged', 'probabilities', the final (steps, 4)
+              distribution, 'wall_time' and 'simulation', a Simulation holding the trace of the best rollout.
+    """
+    if population <= 0:
+        raise ValueError("Population must be positive.")
+    if not (0 < elite_fraction <= 1):
+        raise ValueError("Elite fraction must be between 0 and 1.")
+    if not (0 < smoothing <= 1):
+        raise ValueError("Smoothing must be between 0 and 1.")
+
+    rng = np.random.default_rng(seed)
+    sim = Simulation(copy.deepcopy(vehicle), route, **simulation_kwargs)
+    n_steps = len(route)
+    n_elite = max(int(population * elite_fraction), 1)
+    probabilities = np.full((n_steps, 4), 0.25)
+    if initial_choices is not None:
+        initial_choices = np.asarray(initial_choices, dtype=np.int8)
+        if initial_choices.shape != (n_steps,):
+            raise ValueError("Initial choices must have one value per route sub-segment.")
+        probabilities = (1 - initial_weight) * probabilities + initial_weight * np.eye(4)[initial_choices]
+
+    best_time, best_choices = np.inf, None
+    curve, elite_time = [], []
+    stalled = 0
+    converged = False
+    start = time.perf_counter()
+    for generation in range(max_generations):
+        # Inverse CDF sampling of every sub-segment at once
+        thresholds = np.cumsum(probabilities, axis=1)[:, :3]
+        choices = (rng.random((population, n_steps, 1)) >= thresholds).sum(axis=2).astype(np.int8)
+        if generation == 0 and initial_choices is not None:
+            choices[0] = initial_choices
+        result = sim._batch_rollout(choices)
+
+        complete = result['steps'] == n_steps
+        times = np.where(complete, result['time'], np.inf)
+        elite = np.lexsort((result['time'], -result['steps']))[:n_elite]
+
+        previous = best_time
+        if times[elite[0]] < best_time:
+            best_time = float(times[elite[0]])
+            best_choices = choices[elite[0]].copy()
+        curve.append(best_time)
+        elite_time.append(float(times[elite[-1]]))
+
+        # A sub-segment is only fitted to the elite rollouts that drove it, the others tell nothing about it
+        reached = result['steps'][elite, None] > np.arange(n_steps)
+        counts = reached.sum(axis=0)
+        frequencies = np.stack([((choices[elite] == k) & reached).sum(axis=0) for k in range(4)], axis=1)
+        pooled = frequencies.sum(axis=0) / counts.sum()
+        frequencies = np.where(counts[:, None] > 0, frequencies / np.maximum(counts, 1)[:, None], pooled)
+        probabilities = smoothing * frequencies + (1 - smoothing) * probabilities
+
+        if np.isfinite(best_time) and previous - best_time <= tolerance * best_time:
+            stalled += 1
+        else:
+            stalled = 0
+        if stalled >= patience or np.all(probabilities.max(axis=1) > 1 - 1e-6):
+            converged = True
+            break
+
+    if best_choices is not None:
+        sim.simulate_batch(1, choices=best_choices[None, :])
+
+    return {'time': best_time,
+            'choices': best_choices,
+            'curve': curve,
+            'elite_time': elite_time,
+            'generations': len(curve),
+            'n_rollouts': len(curve) * population,
+            'converged': converged,
+            'probabilities': probabilities,
+            'wall_time': time.perf_counter() - start,
+            'simulation': sim}
+
+
+if __name__ == "__main__":
+    from vehicle import Vehicle
+    from route import Route
+
+    vehi = Vehicle(mass=18000, frontal_area=8.16, velocity_init=5, energy_left=15000, velocity_max=60, energy_max=15000)
+    rout = Route(((10, 0, 0.015),), delta_s=0.5)
+
+    result = parallel_random_search(vehi, rout, 1000000, seed=2024, distance_step=0.5)
+    print(f"Best time: {result['time']} s, {result['n_complete']} complete rollouts in {result['wall_time']:.2f} s")
+
+    result = cross_entropy_search(vehi, rout, seed=2024, distance_step=0.5)
+    print(f"Cross-entropy: {result['time']} s after {result['n_rollouts']} rollouts in {result['wall_time']:.2f} s")
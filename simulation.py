@@ -1,40 +1,80 @@
+import copy
+import json
+import os
+from time import perf_counter
+
 import numpy as np
-import matplotlib.pyplot as plt
+
+import kernels
+from integrator import AdaptiveIntegrator
+from physics import PhysicsModel
+from plotting import plot_trajectory
+from trajectory import Trajectory, TrajectoryWriter
+
+
+def _no_clock():
+    # Stands for perf_counter in the uninstrumented simulate loop
+    return 0.0
 
 
 class Simulation:
-    def __init__(self, vehicle, route, distance_step=1, drag_coefficient=0.6, efficiency=0.86, gravity=9.81, min_velocity=2):
+    # Fixed candidates u1, u2, u3 of calculate_possible_output_power_value, u4 depends on the state
+    fixed_output_powers = (0, 9000, 60000)
+
+    def __init__(self, vehicle, route, distance_step=1, drag_coefficient=0.6, efficiency=0.86, gravity=9.81, min_velocity=2, rng=None, backend='python',
+                 record_every=1, transition_cache=None, instrumentation=None, regeneration=None):
         """
         Initializes the Simulation with a given vehicle and route.
 
         Parameters:
         vehicle (Vehicle): The vehicle object containing vehicle-specific properties.
         route (Route): The route object containing information about the journey.
+        rng (numpy.random.Generator): Random source of power_strategy, default is the global np.random.
+        backend (str): 'python' runs simulate step by step with the methods below, 'numba' runs it in
+                       the compiled kernel of kernels.py and 'interpreted' in the same kernel run by
+                       the Python interpreter, which is also used when Numba is not installed.
+        record_every (int or None): Record one step out of record_every in the state lists, or only the
+                                    initial and final states with None. The final state is always kept.
+        transition_cache (TransitionCache): Optional cache of the transitions used by the step by step
+                                            simulate, one entry per velocity, segment class and power.
+        instrumentation (Instrumentation): Optional timers, counters and per-step probes, see
+                                           instrumentation.py. None runs the uninstrumented loops.
+        regeneration (callable): Regenerative braking model of the physics, see physics.PhysicsModel.
+                                 Default is the historical physics.LinearRegeneration.
 
         Attributes:
         g (float): Acceleration due to gravity in m/s^2.
         C_d (float): Drag coefficient, which could be moved to vehicle properties if it varies per vehicle.
         A (float): Frontal area of the vehicle in m^2, sourced from the vehicle properties.
         eta (float): Efficiency coefficient, assuming constant efficiency across the simulation.
+        physics (PhysicsModel): The force and energy model of every engine of the simulation, built
+                                from the vehicle and the constants above.
+        initial_vehicle (Vehicle): Copy of the vehicle at construction, the vehicle itself changes as the
+                                   simulation runs.
         time (int): Simulation time in seconds, initialized to 0.
-        time_list (list of int): List to record time at each simulation step, starting at 0.
-        distance_step (int): Distance increment for each simulation step in meters.
-        distance_list (list of int): List to record the cumulative distance traveled.
-        velocity_list (list of float): List to record the vehicle's velocity at each step.
-        energy_list (list of float): List to record the vehicle's remaining energy.
-        output_power_list (list of float): List to record the output power at each step.
+        distance_step (int): Distance increment for each simulation step in meters, None uses the
+                             sub-segment lengths of the route.
+        step_distances (ndarray): Distance increment of each sub-segment, the final partial
+                                  sub-segment of a route segment gets its share of distance_step.
+        step_index (int): Next sub-segment driven by simulate_chunks.
+        trajectory (Trajectory): Preallocated record of the time, distance, velocity, energy and output
+                                 power at each step. time_list, distance_list, velocity_list, energy_list
+                                 and output_power_list give them as lists.
         """
 
         if vehicle is None or route is None:
             raise ValueError("Vehicle and route cannot be None.")
-        if distance_step <= 0:
+        if distance_step is not None and distance_step <= 0:
             raise ValueError("Distance step must be positive.")
         if not (0 <= drag_coefficient <= 1):
             raise ValueError("Drag coefficient must be between 0 and 1.")
         if not (0 <= efficiency <= 1):
             raise ValueError("Efficiency must be between 0 and 1.")
+        if backend not in ('python', 'interpreted', 'numba'):
+            raise ValueError("Backend must be 'python', 'interpreted' or 'numba'.")
 
         self.vehicle = vehicle
+        self.initial_vehicle = copy.copy(vehicle)
         self.route = route
 
         # Physical constants
@@ -43,127 +83,541 @@ class Simulation:
         self.A = self.vehicle.frontal_area
         self.eta = efficiency
         self.min_velocity = min_velocity
+        self.physics = PhysicsModel.simulation_model(vehicle, drag_coefficient, gravity, min_velocity,
+                                                     fixed_output_powers=self.fixed_output_powers,
+                                                     regeneration=regeneration)
 
-        # We would record the current status and store them in a list container
-        self.time = 0
-        self.time_list = []
+        self.rng = np.random if rng is None else rng
+        self.backend = 'interpreted' if backend == 'numba' and not kernels.NUMBA_AVAILABLE else backend
+        self.transition_cache = transition_cache
+        self.instrumentation = instrumentation
 
+        # We would record the current status and store them in a preallocated buffer
+        self.time = 0
         self.distance_step = distance_step
-        self.distance_list = []
-
-        self.velocity_list = []
-        self.energy_list = []
-        self.output_power_list = []
+        self.step_distances = self.route.step_distances(distance_step)
+        self.trajectory = Trajectory(len(self.route), record_every)
+        self.step_index = 0  # Next sub-segment of simulate_chunks
 
         self.initialize_state_lists()
 
         
 
     def initialize_state_lists(self):
-        self.time_list = [self.time]
-        self.distance_list = [self.vehicle.covered_distance]
-        self.velocity_list = [self.vehicle.velocity]
-        self.energy_list = [self.vehicle.energy_left]
-        self.output_power_list = [self.vehicle.output_power]
-
-    def update_vehicle_state(self, incline_angle, output_power, mu):
-        rad_angle = np.radians(incline_angle)  # Convert angle to radians
-
-        # Calculate forces
-        gravity_force = self.vehicle.mass * self.g * np.sin(rad_angle)
-        friction_force = self.vehicle.mass * self.g * np.cos(rad_angle) * mu
-        drag_force = self.C_d * self.A * self.vehicle.velocity ** 2 / 2  # Adjusted divisor based on typical air density and speed squared
-
-        # Calculate acceleration
-        total_force = output_power / self.vehicle.velocity - gravity_force - friction_force - drag_force
-        acceleration = total_force / self.vehicle.mass
-
-        # Update velocity
-        delta_v = acceleration * (self.distance_step / max(self.vehicle.velocity, 5)) * 1000  # prevent division by zero
-        new_velocity = max(min(self.vehicle.velocity + delta_v, self.vehicle.velocity_max),
-                           self.min_velocity)  # use a min_velocity attribute
-
-        # Energy updates (assuming all powers are in Watts and all times are in seconds)
-        power_consumed = output_power * (self.distance_step / max(self.vehicle.velocity, 5)) 
-        # power_consumed = self.vehicle.output_power
+        self.trajectory.reset(self.time, self.vehicle.covered_distance, self.vehicle.velocity,
+                              self.vehicle.energy_left, self.vehicle.output_power)
+
+    # The state lists are built on demand from the trajectory, use self.trajectory for array views
+    @property
+    def time_list(self):
+        return self.trajectory.time.tolist()
+
+    @property
+    def distance_list(self):
+        return self.trajectory.distance.tolist()
+
+    @property
+    def velocity_list(self):
+        return self.trajectory.velocity.tolist()
+
+    @property
+    def energy_list(self):
+        return self.trajectory.energy.tolist()
+
+    @property
+    def output_power_list(self):
+        return self.trajectory.output_power.tolist()
+
+    def update_vehicle_state(self, incline_angle, output_power, mu, road_forces=None, distance_step=None):
+        # Calculate forces, road_forces optionally gives the (gravity, friction) forces precomputed by Route
+        if distance_step is None:
+            distance_step = self.distance_step
+        if road_forces is None:
+            road_forces = self.physics.road_forces(incline_angle, mu)
+        gravity_force, friction_force = road_forces
+
+        transition = self.next_state(self.vehicle.velocity, output_power, gravity_force, friction_force, distance_step)
+        self.apply_transition(transition, output_power, distance_step)
+
+    def next_state(self, velocity, output_power, gravity_force, friction_force, distance_step):
+        """
+        Transition of one step from the given velocity, independent of the energy left, see
+        PhysicsModel.transition.
 
-        power_regenerated = -0.740 * self.vehicle.velocity * (
-                    self.distance_step / max(self.vehicle.velocity, 5)) 
+        Returns:
+            tuple: (new_velocity, power_consumed, power_regenerated, delta_t)
+        """
+        return self.physics.transition(velocity, output_power, gravity_force, friction_force, distance_step)
 
-        new_energy = max(self.vehicle.energy_left - power_consumed + power_regenerated, 0)
+    def apply_transition(self, transition, output_power, distance_step):
+        """Moves the vehicle by one step with a transition of next_state and records the new state."""
+        new_velocity, new_energy, delta_t = self.physics.energy_transition(self.vehicle.energy_left, transition)
 
         # Update distance and time
-        new_distance = self.vehicle.covered_distance + self.distance_step
-        delta_t = self.distance_step / max(self.vehicle.velocity, 5) * 3600  # to convert hours to seconds
-        new_time = self.time_list[-1] + delta_t
+        new_distance = self.vehicle.covered_distance + distance_step
+        new_time = self.trajectory.latest('time') + delta_t
 
         # Update vehicle state and lists
         self.vehicle.update_velocity(new_velocity)
         self.vehicle.energy_left = new_energy 
         self.vehicle.covered_distance = new_distance
 
-        self.velocity_list.append(new_velocity)
-        self.energy_list.append(new_energy)
-        self.distance_list.append(new_distance)
-        self.time_list.append(new_time)
-        self.output_power_list.append(np.abs(output_power / 1000))  # Convert watts to kilowatts for recording
-
-    def calculate_possible_output_power_value(self, incline_angle, mu):
-        velocity = self.vehicle.velocity
-        rad_angle = np.radians(incline_angle)
-        u1 = 0
-        u2 = 9000
-        u3 = 60000
-        u4 = self.vehicle.mass * self.g * velocity*(np.sin(rad_angle) + mu * np.cos(rad_angle)) - self.C_d * self.A * velocity ** 2 / 21.15
-        u4 = np.abs(u4)
-        return [u1, u2, u3, u4 / 1000]
+        self.trajectory.append(new_time, new_distance, new_velocity, new_energy,
+                               np.abs(output_power / 1000))  # Convert watts to kilowatts for recording
+
+    def cached_transition(self, velocity, incline_angle, mu, output_power, road_forces, distance_step):
+        """
+        next_state of the chosen power from a quantized velocity, from transition_cache.
+
+        The key is the velocity, the segment class (incline, friction, step length) and the power,
+        like simulation_cp.Simulation.calculate_next_state, so a miss only evaluates the transition
+        that is driven.
+
+        Parameters:
+            velocity (float): The vehicle velocity quantized by the cache, at which the candidates
+                              were evaluated.
+        """
+        return self.transition_cache.get((velocity, incline_angle, mu, distance_step, output_power),
+                                         lambda: self.next_state(velocity, output_power, *road_forces, distance_step))
+
+    def calculate_possible_output_power_value(self, incline_angle, mu, sin_cos=None):
+        if sin_cos is None:
+            rad_angle = np.radians(incline_angle)
+            sin_cos = (np.sin(rad_angle), np.cos(rad_angle))
+        return self.possible_output_power_values_at(self.vehicle.velocity, sin_cos, mu)
+
+    def possible_output_power_values_at(self, velocity, sin_cos, mu):
+        """calculate_possible_output_power_value at the given velocity instead of the vehicle one."""
+        sin_angle, cos_angle = sin_cos
+        u1, u2, u3 = self.fixed_output_powers
+        return [u1, u2, u3, self.physics.grade_power(velocity, sin_angle, cos_angle, mu)]
 
     def power_strategy(self, output_values):
-        output_u = np.random.choice(output_values)
+        output_u = self.rng.choice(output_values)
         return output_u
 
 
     def simulate(self):
+        if self.backend != 'python':
+            self.simulate_kernel()
+            return
+
+        # Without instrumentation the clock is a no-op and the accounting below is skipped
+        instrumentation = self.instrumentation
+        clock = _no_clock if instrumentation is None else perf_counter
+        probes = instrumentation is not None and bool(instrumentation.callbacks)
+        strategy_time = physics_time = record_time = probe_time = 0.0
+        steps = clamp_max = clamp_min = 0
+        exhausted = False
+
         self.initialize_state_lists()
-        for distance, incline_angle, mu in self.route.road_info_list:
+        # Trigonometry and road forces come precomputed from the route
+        sin_angles, cos_angles = self.route.sin_array.tolist(), self.route.cos_array.tolist()
+        gravity_forces, friction_forces = (forces.tolist() for forces in self.route.road_forces(self.vehicle.mass, self.g))
+        step_distances = self.step_distances.tolist()
+        velocity_max = self.vehicle.velocity_max
+        for k, (distance, incline_angle, mu) in enumerate(self.route.road_info_list):
             # print(f"Road: {distance}, incli: {incline_angle}, mu: {mu}")
-            possible_output_values = self.calculate_possible_output_power_value(incline_angle, mu)
-            self.vehicle.output_power = self.power_strategy(possible_output_values)
-            # print(self.vehicle.output_power)
-            self.update_vehicle_state(incline_angle, self.vehicle.output_power, mu)
+            start = clock()
+            if self.transition_cache is not None:
+                velocity = self.transition_cache.quantize(self.vehicle.velocity)
+                possible_output_values = self.possible_output_power_values_at(velocity, (sin_angles[k], cos_angles[k]), mu)
+                self.vehicle.output_power = self.power_strategy(possible_output_values)
+                chosen = clock()
+                transition = self.cached_transition(velocity, incline_angle, mu, self.vehicle.output_power,
+                                                    (gravity_forces[k], friction_forces[k]), step_distances[k])
+            else:
+                possible_output_values = self.calculate_possible_output_power_value(incline_angle, mu, (sin_angles[k], cos_angles[k]))
+                self.vehicle.output_power = self.power_strategy(possible_output_values)
+                # print(self.vehicle.output_power)
+                chosen = clock()
+                transition = self.next_state(self.vehicle.velocity, self.vehicle.output_power, gravity_forces[k],
+                                             friction_forces[k], step_distances[k])
+            stepped = clock()
+            self.apply_transition(transition, self.vehicle.output_power, step_distances[k])
 
             if self.vehicle.velocity < self.min_velocity:
                 self.vehicle.velocity = self.min_velocity
 
+            if instrumentation is not None:
+                recorded = perf_counter()
+                strategy_time += chosen - start
+                physics_time += stepped - chosen
+                record_time += recorded - stepped
+                steps += 1
+                clamp_max += transition[0] >= velocity_max
+                clamp_min += transition[0] <= self.min_velocity
+                if probes:
+                    instrumentation.step(self, k)
+                    probe_time += perf_counter() - recorded
+
             if self.vehicle.energy_left < 2:
+                exhausted = True
                 break
 
-    def plot_results(self):
-        plt.figure(figsize=(12, 8))
-
-        plt.subplot(4, 1, 1)
-        plt.plot(self.distance_list, self.time_list, label='Time (s)')
-        plt.xlabel('Distance (km)')
-        plt.ylabel('Time (s)')
-        plt.legend()
-
-        plt.subplot(4, 1, 2)
-        plt.stem(self.distance_list, self.output_power_list, label='Power Output (kW)')
-        plt.xlabel('Distance (km)')
-        plt.ylabel('Power Output (kW)')
-        plt.legend()
-
-        plt.subplot(4, 1, 3)
-        plt.plot(self.distance_list, self.velocity_list, label='Velocity (km/h)')
-        plt.xlabel('Distance (km)')
-        plt.ylabel('Velocity (km/h)')
-        plt.legend()
-
-        plt.subplot(4, 1, 4)
-        plt.plot(self.distance_list, self.energy_list, label='Energy (kJ)')
-        plt.xlabel('Distance (km)')
-        plt.ylabel('Energy (kJ)')
-        plt.legend()
-
-        plt.tight_layout()
-        plt.show()
+        if instrumentation is not None:
+            instrumentation.count('rollouts')
+            instrumentation.add_time('strategy', strategy_time, steps)
+            instrumentation.add_time('physics', physics_time, steps)
+            instrumentation.add_time('record', record_time, steps)
+            if probes:
+                instrumentation.add_time('callbacks', probe_time, steps)
+            instrumentation.count('steps', steps)
+            instrumentation.count('velocity_clamp_max', int(clamp_max))
+            instrumentation.count('velocity_clamp_min', int(clamp_min))
+            if exhausted:
+                instrumentation.count('energy_exhausted')
+
+    def _count_rollout(self, phase, seconds, velocity, exhausted):
+        """Counts one rollout of a whole-route path in self.instrumentation from its velocity trace."""
+        instrumentation = self.instrumentation
+        instrumentation.add_time(phase, seconds)
+        instrumentation.count('rollouts')
+        instrumentation.count('steps', len(velocity) - 1)
+        instrumentation.count('velocity_clamp_max', int(np.sum(velocity[1:] >= self.vehicle.velocity_max)))
+        instrumentation.count('velocity_clamp_min', int(np.sum(velocity[1:] <= self.min_velocity)))
+        if exhausted:
+            instrumentation.count('energy_exhausted')
+
+    def simulate_chunks(self, chunk_size=10000, choices=None, spill=None):
+        """
+        Runs simulate step by step as a generator of trajectory chunks, with bounded memory.
+
+        Starts from sub-segment step_index and the latest recorded state, so a simulation restored
+        from a snapshot continues where it stopped. The generator can be paused or closed between
+        chunks, step_index and the vehicle then give the state after the last yielded step. Only
+        the current chunk is held in memory: afterwards the state lists hold the state before the
+        run and the latest one.
+
+        Parameters:
+            chunk_size (int): Number of steps per chunk.
+            choices (ndarray of int): Optional index in 0..3 of the candidate used on each sub-segment,
+                                      chosen by power_strategy by default.
+            spill (str): Optional .npy (memory-mapped) or raw float64 file receiving every chunk, see
+                         trajectory.TrajectoryWriter. Row k is the state after k steps, a resumed run
+                         continues the file.
+
+        Yields:
+            ndarray: Shape (5, steps) with the time, distance, velocity, energy and output power after each step.
+        """
+        if chunk_size <= 0:
+            raise ValueError("Chunk size must be positive.")
+        n_steps = len(self.route)
+        start = self.step_index
+        first_state = self.trajectory.last.copy()
+
+        writer = None
+        if spill is not None:
+            writer = TrajectoryWriter(spill, n_steps + 1, resume_at=start + 1 if start > 0 else None)
+            if start == 0:
+                writer.write(0, first_state[:, None])
+
+        sin_angles, cos_angles = self.route.sin_array, self.route.cos_array
+        gravity_forces, friction_forces = self.route.road_forces(self.vehicle.mass, self.g)
+        trajectory = self.trajectory
+        chunk = Trajectory(chunk_size)
+        chunk.reset(*first_state)
+        self.trajectory = chunk
+        if self.instrumentation is not None and start == 0:
+            self.instrumentation.count('rollouts')
+        try:
+            for k in range(start, n_steps):
+                incline_angle, mu = float(self.route.angle_array[k]), float(self.route.mu_array[k])
+                possible_output_values = self.calculate_possible_output_power_value(
+                    incline_angle, mu, (float(sin_angles[k]), float(cos_angles[k])))
+                if choices is None:
+                    self.vehicle.output_power = self.power_strategy(possible_output_values)
+                else:
+                    self.vehicle.output_power = possible_output_values[choices[k]]
+                self.update_vehicle_state(incline_angle, self.vehicle.output_power, mu,
+                                          (float(gravity_forces[k]), float(friction_forces[k])), float(self.step_distances[k]))
+                if self.vehicle.velocity < self.min_velocity:
+                    self.vehicle.velocity = self.min_velocity
+                if self.instrumentation is not None:
+                    self.instrumentation.count('steps')
+                    self.instrumentation.step(self, k)
+
+                stopped = self.vehicle.energy_left < 2
+                if chunk.steps == chunk_size or stopped or k == n_steps - 1:
+                    block = chunk.arrays()[:, 1:].copy()
+                    if writer is not None:
+                        writer.write(k + 2 - block.shape[1], block)
+                        writer.flush()
+                    self.step_index = k + 1
+                    chunk.reset(*chunk.last)
+                    yield block
+                if stopped:
+                    if self.instrumentation is not None:
+                        self.instrumentation.count('energy_exhausted')
+                    break
+        finally:
+            if writer is not None:
+                writer.close()
+            # The trajectory of the simulation is kept, with its record_every and its buffer
+            self.trajectory = trajectory
+            self.trajectory.reset(*first_state)
+            if self.step_index > start:
+                self.trajectory.append(*chunk.last)
+
+    def snapshot(self):
+        """
+        Returns the state needed to resume a simulate_chunks run: the vehicle, the latest recorded
+        state, step_index and the state of the random generator.
+        """
+        if isinstance(self.rng, np.random.Generator):
+            rng_state = self.rng.bit_generator.state
+        else:
+            name, keys, position, has_gauss, cached_gaussian = self.rng.get_state()
+            rng_state = [name, keys.tolist(), position, has_gauss, cached_gaussian]
+        return {'vehicle': dict(vars(self.vehicle)),
+                'latest': self.trajectory.last.tolist(),
+                'step_index': self.step_index,
+                'rng': rng_state}
+
+    def restore(self, snapshot):
+        """Puts the simulation back in the state of a snapshot, the state lists restart from it."""
+        for name, value in snapshot['vehicle'].items():
+            setattr(self.vehicle, name, value)
+        self.step_index = snapshot['step_index']
+        self.trajectory.reset(*snapshot['latest'])
+        if isinstance(self.rng, np.random.Generator):
+            self.rng.bit_generator.state = snapshot['rng']
+        else:
+            name, keys, position, has_gauss, cached_gaussian = snapshot['rng']
+            self.rng.set_state((name, np.array(keys, dtype=np.uint32), position, has_gauss, cached_gaussian))
+
+    def save_snapshot(self, path):
+        """Writes snapshot() to a JSON file, replacing it atomically."""
+        temporary = path + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(self.snapshot(), f)
+        os.replace(temporary, path)
+
+    def load_snapshot(self, path):
+        """Restores a snapshot written by save_snapshot."""
+        with open(path) as f:
+            self.restore(json.load(f))
+
+    def simulate_kernel(self, choices=None):
+        """
+        Runs simulate in the kernel of kernels.py, on flat float64 arrays.
+
+        Given the same choices, the results are identical to the step by step simulate. The random
+        choices for the whole route are drawn at once, so the random stream is not consumed the same way.
+        The kernel has the LinearRegeneration of the physics built in, other models raise ValueError.
+        With the 'python' backend, the compiled kernel is used when Numba is installed.
+
+        Parameters:
+            choices (ndarray of int): Optional index in 0..3 of the candidate used on each sub-segment,
+                                      drawn uniformly like power_strategy by default.
+        """
+        if choices is None:
+            choices = self.rng.choice(4, size=len(self.route))
+        choices = np.asarray(choices, dtype=np.int64)
+
+        params = self.physics.kernel_parameters()
+        state = np.array([self.vehicle.velocity, self.vehicle.energy_left, self.vehicle.covered_distance, self.time,
+                          self.vehicle.output_power], dtype=float)
+        start = perf_counter()
+        steps, time, distance, velocity, energy, output_power = kernels.rollout(
+            self.route.sin_array, self.route.cos_array, self.route.mu_array, self.step_distances, choices, params, state,
+            backend='numba' if self.backend == 'python' else self.backend)
+        if self.instrumentation is not None:
+            self._count_rollout('kernel', perf_counter() - start, velocity, steps < len(choices))
+
+        self.trajectory.load(time, distance, velocity, energy, output_power)
+        if steps > 0:
+            self.vehicle.update_velocity(velocity[-1])
+            if self.vehicle.velocity < self.min_velocity:
+                self.vehicle.velocity = self.min_velocity
+            self.vehicle.energy_left = energy[-1]
+            self.vehicle.covered_distance = distance[-1]
+            self.vehicle.output_power = output_power[-1] * 1000
+
+    def simulate_adaptive(self, choices=None, tolerance=1e-6, **integrator_kwargs):
+        """
+        Runs simulate with error controlled steps instead of the fixed distance_step.
+
+        The schedule keeps one candidate per sub-segment, see integrator.AdaptiveIntegrator. The
+        state lists hold the accepted steps, which are long on constant stretches and short after
+        segment boundaries and power switches.
+
+        Parameters:
+            choices (ndarray of int): Optional index in 0..3 of the candidate used on each sub-segment,
+                                      drawn uniformly like power_strategy by default.
+            tolerance (float): Relative tolerance of the local error.
+            **integrator_kwargs: Extra arguments of AdaptiveIntegrator (initial_step, max_step, min_step).
+
+        Returns:
+            AdaptiveIntegrator: The integrator, with its counts of accepted and rejected steps.
+        """
+        if choices is None:
+            choices = self.rng.choice(4, size=len(self.route))
+        integrator = AdaptiveIntegrator(self, tolerance=tolerance, **integrator_kwargs)
+        start = perf_counter()
+        time, distance, velocity, energy, output_power = integrator.integrate(np.asarray(choices))
+        if self.instrumentation is not None:
+            self._count_rollout('adaptive', perf_counter() - start, velocity, energy[-1] < 2)
+            self.instrumentation.count('rejected_steps', integrator.n_rejected)
+
+        self.trajectory.load(time, distance, velocity, energy, output_power)
+        if len(time) > 1:
+            self.vehicle.update_velocity(velocity[-1])
+            self.vehicle.energy_left = energy[-1]
+            self.vehicle.covered_distance = distance[-1]
+            self.vehicle.output_power = output_power[-1] * 1000
+        return integrator
+
+    def _batch_rollout(self, choices, record=False):
+        """
+        Advances a batch of rollouts over the route at once, starting from the current vehicle state.
+
+        Reproduces the recurrences of update_vehicle_state and the stopping rule of simulate
+        (velocity clamping, energy floored at 0, stop once energy_left < 2) on arrays.
+
+        Parameters:
+            choices (ndarray of int): Shape (rollouts, steps), index in 0..3 of the candidate
+                                      of calculate_possible_output_power_value used at each step.
+            record (bool): If True, also returns the full traces, shape (rollouts, steps + 1).
+
+        Returns:
+            dict: Final 'time', 'distance', 'velocity', 'energy' and 'steps' per rollout,
+                  plus the traces when record is True. Steps after a stop repeat the last state.
+        """
+        n_rollouts, n_steps = choices.shape
+        if n_steps != len(self.route):
+            raise ValueError("Choices must have one column per route sub-segment.")
+
+        physics = self.physics
+        u1, u2, u3 = self.fixed_output_powers
+        sin_angles, cos_angles, mus = self.route.sin_array, self.route.cos_array, self.route.mu_array
+        gravity_forces, friction_forces = self.route.road_forces(self.vehicle.mass, self.g)
+        step_distances = self.step_distances
+
+        velocity = np.full(n_rollouts, float(self.vehicle.velocity))
+        energy = np.full(n_rollouts, float(self.vehicle.energy_left))
+        distance = np.full(n_rollouts, float(self.vehicle.covered_distance))
+        time = np.full(n_rollouts, float(self.time))
+        steps = np.zeros(n_rollouts, dtype=np.int64)
+        running = np.ones(n_rollouts, dtype=bool)
+
+        if record:
+            traces = {name: np.empty((n_rollouts, n_steps + 1)) for name in
+                      ('time', 'distance', 'velocity', 'energy', 'output_power')}
+            traces['time'][:, 0] = time
+            traces['distance'][:, 0] = distance
+            traces['velocity'][:, 0] = velocity
+            traces['energy'][:, 0] = energy
+            traces['output_power'][:, 0] = self.vehicle.output_power
+
+        for k in range(n_steps):
+            velocity_squared = physics.square(velocity)
+
+            # Candidate powers, u4 holds the grade at the current velocity
+            u4 = physics.grade_power(velocity, sin_angles[k], cos_angles[k], mus[k], velocity_squared)
+            output_power = np.choose(choices[:, k], (np.full(n_rollouts, float(u1)), np.full(n_rollouts, float(u2)),
+                                                     np.full(n_rollouts, float(u3)), u4))
+
+            step = physics.transition(velocity, output_power, gravity_forces[k], friction_forces[k], step_distances[k],
+                                      velocity_squared)
+            new_velocity, new_energy, delta_t = physics.energy_transition(energy, step)
+
+            velocity = np.where(running, new_velocity, velocity)
+            energy = np.where(running, new_energy, energy)
+            distance = np.where(running, distance + step_distances[k], distance)
+            time = np.where(running, time + delta_t, time)
+            steps += running
+
+            if record:
+                traces['time'][:, k + 1] = time
+                traces['distance'][:, k + 1] = distance
+                traces['velocity'][:, k + 1] = velocity
+                traces['energy'][:, k + 1] = energy
+                traces['output_power'][:, k + 1] = np.where(running, np.abs(output_power / 1000),
+                                                            traces['output_power'][:, k])
+
+            running &= energy >= 2
+            if not running.any():
+                if record:
+                    for trace in traces.values():
+                        trace[:, k + 2:] = trace[:, k + 1:k + 2]
+                break
+
+        result = {'time': time, 'distance': distance, 'velocity': velocity, 'energy': energy, 'steps': steps}
+        if record:
+            result['traces'] = traces
+        return result
+
+    @staticmethod
+    def _random_choices(rng, size):
+        """Uniform candidate indices from a Generator, or from the legacy np.random / RandomState."""
+        if isinstance(rng, np.random.Generator):
+            return rng.integers(0, 4, size=size, dtype=np.int8)
+        return rng.randint(0, 4, size=size, dtype=np.int8)
+
+    def simulate_batch(self, n_rollouts, batch_size=100000, rng=None, choices=None):
+        """
+        Random search over power sequences, evaluating whole batches of rollouts as NumPy arrays.
+
+        Equivalent to calling simulate n_rollouts times on fresh copies of the vehicle and keeping
+        the fastest rollout that covers the whole route. The vehicle itself is left untouched; the
+        state lists are filled with the trace of the best rollout so plot_results can be used.
+
+        Parameters:
+            n_rollouts (int): Number of random power sequences to evaluate.
+            batch_size (int): Number of rollouts advanced together, bounds the memory use.
+            rng (numpy.random.Generator, int or None): Source of the random choices, default is self.rng.
+            choices (ndarray of int): Optional (rollouts, steps) candidate indices to evaluate
+                                      instead of random ones, n_rollouts is then ignored.
+
+        Returns:
+            dict: 'time' of the best complete rollout (inf if none), its 'choices' and
+                  'output_power' sequences, and 'n_complete', the number of complete rollouts.
+        """
+        if batch_size <= 0:
+            raise ValueError("Batch size must be positive.")
+        rng = self.rng if rng is None else np.random.default_rng(rng)
+        n_steps = len(self.route)
+        if choices is not None:
+            choices = np.asarray(choices)
+            n_rollouts = len(choices)
+
+        best_time = np.inf
+        best_choices = None
+        n_complete = 0
+        for start in range(0, n_rollouts, batch_size):
+            size = min(batch_size, n_rollouts - start)
+            if choices is None:
+                batch_choices = self._random_choices(rng, (size, n_steps))
+            else:
+                batch_choices = choices[start:start + size]
+            batch_start = perf_counter()
+            result = self._batch_rollout(batch_choices)
+
+            complete = result['steps'] == n_steps
+            n_complete += int(complete.sum())
+            if self.instrumentation is not None:
+                self.instrumentation.add_time('batch', perf_counter() - batch_start)
+                self.instrumentation.count('rollouts', size)
+                self.instrumentation.count('steps', int(result['steps'].sum()))
+                self.instrumentation.count('energy_exhausted', size - int(complete.sum()))
+            times = np.where(complete, result['time'], np.inf)
+            best = int(np.argmin(times))
+            if times[best] < best_time:
+                best_time = float(times[best])
+                best_choices = batch_choices[best].copy()
+
+        output_power = None
+        if best_choices is not None:
+            traces = self._batch_rollout(best_choices[None, :], record=True)['traces']
+            self.trajectory.load(*(traces[field][0] for field in Trajectory.fields))
+            output_power = traces['output_power'][0, 1:] * 1000
+
+        return {'time': best_time, 'choices': best_choices, 'output_power': output_power, 'n_complete': n_complete}
+
+    def plot_results(self, path=None):
+        """
+        Plots the recorded time, output power, velocity and energy against the distance, see
+        plotting.plot_trajectory. With a path the figure is written to the file instead of shown.
+        """
+        return plot_trajectory(self.trajectory, path=path)
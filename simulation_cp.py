@@ -1,33 +1,53 @@
+import copy
+from time import perf_counter
+
 import numpy as np
-import matplotlib.pyplot as plt
+
+from physics import PhysicsModel
+from plotting import plot_trajectory
+from trajectory import Trajectory
+from transition_cache import TransitionCache
 
 
 class Simulation:
-    def __init__(self, vehicle, route, distance_step=1, drag_coefficient=0.6, efficiency=0.86, gravity=9.81, min_velocity=2):
+    def __init__(self, vehicle, route, distance_step=1, drag_coefficient=0.6, efficiency=0.86, gravity=9.81, min_velocity=2, record_every=1,
+                 transition_cache=None, instrumentation=None, regeneration=None):
         """
         Initializes the Simulation with a given vehicle and route.
 
         Parameters:
         vehicle (Vehicle): The vehicle object containing vehicle-specific properties.
         route (Route): The route object containing information about the journey.
+        record_every (int or None): Record one step out of record_every in the state lists, or only the
+                                    initial and final states with None. The final state is always kept.
+        transition_cache (TransitionCache): Optional cache of the transitions of calculate_next_state and of
+                                            the grid transitions of dynamic_programming_approach.
+        instrumentation (Instrumentation): Optional timers, counters and per-step probes of
+                                           dynamic_programming_approach, see instrumentation.py.
+        regeneration (callable): Regenerative braking model of the physics, see physics.PhysicsModel.
+                                 Default is the historical physics.LinearRegeneration.
 
         Attributes:
         g (float): Acceleration due to gravity in m/s^2.
         C_d (float): Drag coefficient, which could be moved to vehicle properties if it varies per vehicle.
         A (float): Frontal area of the vehicle in m^2, sourced from the vehicle properties.
         eta (float): Efficiency coefficient, assuming constant efficiency across the simulation.
+        physics (PhysicsModel): The force and energy model in SI units, built from the vehicle and
+                                the constants above, shared by the transitions and the solvers.
+        initial_vehicle (Vehicle): Copy of the vehicle at construction, the vehicle itself changes as the
+                                   simulation runs.
         time (int): Simulation time in seconds, initialized to 0.
-        time_list (list of int): List to record time at each simulation step, starting at 0.
-        distance_step (int): Distance increment for each simulation step in meters.
-        distance_list (list of int): List to record the cumulative distance traveled.
-        velocity_list (list of float): List to record the vehicle's velocity at each step.
-        energy_list (list of float): List to record the vehicle's remaining energy.
-        output_power_list (list of float): List to record the output power at each step.
+        distance_step (int): Distance increment for each simulation step in meters, None uses the
+                             sub-segment lengths of the route.
+        step_distances (ndarray): Distance increment of each sub-segment, see Route.step_distances.
+        trajectory (Trajectory): Preallocated record of the time, distance, velocity, energy and output
+                                 power at each step. time_list, distance_list, velocity_list, energy_list
+                                 and output_power_list give them as lists.
         """
 
         if vehicle is None or route is None:
             raise ValueError("Vehicle and route cannot be None.")
-        if distance_step <= 0:
+        if distance_step is not None and distance_step <= 0:
             raise ValueError("Distance step must be positive.")
         if not (0 <= drag_coefficient <= 1):
             raise ValueError("Drag coefficient must be between 0 and 1.")
@@ -35,6 +55,7 @@ class Simulation:
             raise ValueError("Efficiency must be between 0 and 1.")
 
         self.vehicle = vehicle
+        self.initial_vehicle = copy.copy(vehicle)
         self.route = route
 
         # Physical constants
@@ -43,120 +64,183 @@ class Simulation:
         self.A = self.vehicle.frontal_area
         self.eta = efficiency
         self.min_velocity = min_velocity
-        
+        self.physics = PhysicsModel.simulation_cp_model(vehicle, drag_coefficient, gravity, min_velocity,
+                                                        regeneration=regeneration)
+
+        self.transition_cache = transition_cache
+        self.instrumentation = instrumentation
         self.policy = None
+        self.expected_time = None
 
-        # We would record the current status and store them in a list container
+        # We would record the current status and store them in a preallocated buffer
         self.time = 0
-        self.time_list = []
-
         self.distance_step = distance_step
-        self.distance_list = []
-
-        self.velocity_list = []
-        self.energy_list = []
-        self.output_power_list = []
+        self.step_distances = self.route.step_distances(distance_step)
+        self.trajectory = Trajectory(len(self.route), record_every)
 
         self.initialize_state_lists()
 
         
 
     def initialize_state_lists(self):
-        self.time_list = [self.time]
-        self.distance_list = [self.vehicle.covered_distance]
-        self.velocity_list = [self.vehicle.velocity]
-        self.energy_list = [self.vehicle.energy_left]
-        self.output_power_list = [self.vehicle.output_power]
+        self.trajectory.reset(self.time, self.vehicle.covered_distance, self.vehicle.velocity,
+                              self.vehicle.energy_left, self.vehicle.output_power)
+
+    # The state lists are built on demand from the trajectory, use self.trajectory for array views
+    @property
+    def time_list(self):
+        return self.trajectory.time.tolist()
+
+    @property
+    def distance_list(self):
+        return self.trajectory.distance.tolist()
+
+    @property
+    def velocity_list(self):
+        return self.trajectory.velocity.tolist()
+
+    @property
+    def energy_list(self):
+        return self.trajectory.energy.tolist()
+
+    @property
+    def output_power_list(self):
+        return self.trajectory.output_power.tolist()
 
     def update_vehicle_state(self, incline_angle, output_power, mu):
-        rad_angle = np.radians(incline_angle)  # Convert angle to radians
+        """Drives one distance step with the given power, see calculate_next_state and record_state."""
+        new_velocity, new_energy, delta_t = self.calculate_next_state(incline_angle, output_power, mu)
+        self.record_state(new_velocity, new_energy, delta_t, output_power)
+        return new_velocity, new_energy, delta_t
 
-        # Calculate forces
-        gravity_force = self.vehicle.mass * self.g * np.sin(rad_angle)
-        friction_force = self.vehicle.mass * self.g * np.cos(rad_angle) * mu
-        drag_force = self.C_d * self.A * self.vehicle.velocity ** 2 / 2  # Adjusted divisor based on typical air density and speed squared
+    def possible_output_power_values(self, incline_angle, mu, sin_cos=None):
+        if sin_cos is None:
+            rad_angle = np.radians(incline_angle)
+            sin_cos = (np.sin(rad_angle), np.cos(rad_angle))
+        sin_angle, cos_angle = sin_cos
+        u1, u2, u3 = self.physics.fixed_output_powers
+        return [u1, u2, u3, self.physics.grade_power(self.vehicle.velocity, sin_angle, cos_angle, mu)]
 
-        # Calculate acceleration
-        total_force = output_power / self.vehicle.velocity - gravity_force - friction_force - drag_force
-        acceleration = total_force / self.vehicle.mass
+    def candidate_powers(self, velocity, incline_angle, mu, sin_cos=None):
+        """
+        Vectorized possible_output_power_values.
 
-        # Update velocity
-        delta_v = acceleration * (self.distance_step / max(self.vehicle.velocity, 0.1))  # prevent division by zero
-        new_velocity = max(min(self.vehicle.velocity + delta_v, self.vehicle.velocity_max),
-                           self.min_velocity)  # use a min_velocity attribute
+        Parameters:
+            velocity (ndarray): Velocities in m/s, any shape.
+            incline_angle (float): Incline angle of the sub-segment in degrees.
+            mu (float): Friction coefficient of the sub-segment.
+            sin_cos (tuple): Optional sin and cos of the incline angle, precomputed by Route.
 
-        # Energy updates (assuming all powers are in Watts and all times are in seconds)
-        # power_consumed = output_power * (self.distance_step / max(self.vehicle.velocity, 0.1))
-        power_consumed = self.vehicle.output_power
+        Returns:
+            ndarray: Shape (4,) + velocity.shape, the candidates u1..u4 for each velocity.
+        """
+        if sin_cos is None:
+            rad_angle = np.radians(incline_angle)
+            sin_cos = (np.sin(rad_angle), np.cos(rad_angle))
+        return self.physics.candidate_powers(velocity, sin_cos[0], sin_cos[1], mu)
 
-        power_regenerated = -0.740 * self.vehicle.velocity * (
-                    self.distance_step / max(self.vehicle.velocity, 0.1))  # assuming negative for regeneration
+    def dynamic_programming_approach(self, velocity_bins=41, energy_bins=41):
+        """
+        Minimum time power policy by backward dynamic programming over a (velocity, energy) grid.
+
+        The stages are the sub-segments of route.road_info_list. For every stage, the
+        transitions of calculate_next_state are evaluated at once for all grid states and the
+        four power candidates, the cost-to-go of the next stage is interpolated bilinearly at
+        the reached states and the argmin candidate is kept as back-pointer. Transitions
+        that would need more energy than is left are infeasible, and the interpolation only
+        weighs the feasible neighbours of a reached state: a stage drains much less than one
+        energy bin, so letting any infeasible neighbour poison the cost would lose one energy
+        row per stage and make every state infeasible on long routes. The forward pass then drives
+        the vehicle from its current state, following the back-pointer of the nearest grid
+        state (the energy is rounded down so the grid never assumes more energy than is left).
 
-        new_energy = max(self.vehicle.energy_left - power_consumed + power_regenerated, 0)
+        Parameters:
+            velocity_bins (int): Number of velocity nodes between min_velocity and velocity_max.
+            energy_bins (int): Number of energy nodes between 0 and the energy capacity.
 
-        # Update distance and time
-        new_distance = self.vehicle.covered_distance + self.distance_step
-        delta_t = self.distance_step / max(self.vehicle.velocity, 0.1) * 3600  # to convert hours to seconds
-        new_time = self.time_list[-1] + delta_t
+        Returns:
+            ndarray: The output power applied on each sub-segment.
+        """
+        if velocity_bins < 2 or energy_bins < 2:
+            raise ValueError("The grid needs at least two nodes per dimension.")
 
-        # Update vehicle state and lists
-        self.vehicle.update_velocity(new_velocity)
-        self.vehicle.energy_left = new_energy
-        self.vehicle.covered_distance = new_distance
+        road_info = self.route.road_info_list
+        N = len(road_info)
+        velocity_grid = np.linspace(self.min_velocity, self.vehicle.velocity_max, velocity_bins)
+        energy_grid = np.linspace(0, max(self.vehicle.energy_max, self.vehicle.energy_left), energy_bins)
+        velocity_step = velocity_grid[1] - velocity_grid[0]
+        energy_step = energy_grid[1] - energy_grid[0]
 
-        self.velocity_list.append(new_velocity)
-        self.energy_list.append(new_energy)
-        self.distance_list.append(new_distance)
-        self.time_list.append(new_time)
-        self.output_power_list.append(output_power / 1000)  # Convert watts to kilowatts for recording
+        # Back-pointers: index of the best candidate for every stage and grid state
+        back_pointers = np.zeros((N, velocity_bins, energy_bins), dtype=np.uint8)
+        J = np.zeros((velocity_bins, energy_bins))  # Cost-to-go after the last sub-segment
 
-        return new_velocity, new_energy, delta_t
+        # Trigonometry and road forces come precomputed from the route
+        sin_angles, cos_angles = self.route.sin_array, self.route.cos_array
+        gravity_forces, friction_forces = self.route.road_forces(self.vehicle.mass, self.g)
+        step_distances = self.step_distances
+
+        # Stages of the same segment class share their transitions on the grid, which do not
+        # depend on the energy, so that constant grade stretches are only evaluated once
+        cache = TransitionCache() if self.transition_cache is None else self.transition_cache
+        grid_key = ('grid', self.min_velocity, self.vehicle.velocity_max, velocity_bins)
+
+        instrumentation = self.instrumentation
+        if instrumentation is not None:
+            start = perf_counter()
+
+        velocity = velocity_grid[None, :, None]
+        energy = energy_grid[None, None, :]
+        for i in range(N - 1, -1, -1):
+            _, incline_angle, mu = road_info[i]
+
+            def stage_transitions():
+                powers = self.candidate_powers(velocity_grid, incline_angle, mu, (sin_angles[i], cos_angles[i]))[:, :, None]
+                return self.velocity_transition(velocity, powers, gravity_forces[i], friction_forces[i], step_distances[i])
+
+            step = cache.get(grid_key + (incline_angle, mu, float(step_distances[i])), stage_transitions)
+            new_velocity, new_energy, delta_t = self.energy_transition(energy, step, clamp_energy=False)
 
-    def possible_output_power_values(self, incline_angle, mu):
-        rad_angle = np.radians(incline_angle)
-        u1 = 0
-        u2 = 9000
-        u3 = 150000
-        u4 = self.vehicle.mass * self.g * self.vehicle.velocity * (np.sin(rad_angle) + mu * np.cos(rad_angle)) - self.C_d * self.A * self.vehicle.velocity ** 2 / 21.15
-        return [u1, u2, u3, u4]
-
-
-    def dynamic_programming_approach(self):
-        N = len(self.route.distance_list)
-        print(f"Length of self.distance_list: {len(self.distance_list)}")
-        print(f"Value of N (number of route segments): {N}")
-        J = np.full((N+1, 4), np.inf)  # Set initial costs to infinity
-
-
-        # Backward pass to calculate the costs
-        for i in range(N-1, -1, -1):
-            # Print the current index and the lengths of the lists
-            print(f"Current segment index: {i}")
-            print(f"Length of self.distance_list: {len(self.distance_list)}")
-            print(f"Length of self.velocity_list: {len(self.velocity_list)}")
-            for j in range(4):
-                possible_powers = self.possible_output_power_values(self.route.inclination_angle_list[i], self.route.mu_list[i])
-                costs = []
-                for power in possible_powers:
-                    new_velocity, new_energy, _ = self.calculate_next_state(self.route.inclination_angle_list[i], power, self.route.mu_list[i])
-
-                    if i == N-1:
-                        # If it's the last segment, we use the last available distance value
-                        delta_t = self.distance_list[-1] / max(new_velocity, self.min_velocity) * 3600
-                    else:
-                        # For all other segments, we use i+1
-                        delta_t = self.distance_list[i+1] / max(new_velocity, self.min_velocity) * 3600
-
-                    cost = delta_t if new_velocity > 0 else np.inf
-                    costs.append(cost + J[i+1, j])
-                J[i, j] = min(costs)
+            costs = delta_t + self._interpolate_cost(J, new_velocity, new_energy, velocity_grid, energy_grid)
+            costs[new_energy < 0] = np.inf
+
+            back_pointers[i] = np.argmin(costs, axis=0)
+            J = np.min(costs, axis=0)
+
+        # Expected time from the current state of the vehicle
+        self.expected_time = float(self._interpolate_cost(J, self.vehicle.velocity, self.vehicle.energy_left, velocity_grid, energy_grid))
+
+        if instrumentation is not None:
+            backward_end = perf_counter()
+            instrumentation.add_time('dp_backward', backward_end - start, N)
+            clamp_max = clamp_min = 0
 
         # Forward pass to find the optimal policy
+        self.initialize_state_lists()
         policy = np.zeros(N)
-        for i in range(N):
-            min_cost, min_cost_index = min((cost, idx) for idx, cost in enumerate(J[i]))
-            policy[i] = possible_powers[min_cost_index]
-            self.update_vehicle_state(self.route.inclination_angle_list[i], policy[i], self.route.mu_list[i])
+        for i, (_, incline_angle, mu) in enumerate(road_info):
+            velocity_index = int(np.clip(np.rint((self.vehicle.velocity - self.min_velocity) / velocity_step), 0, velocity_bins - 1))
+            energy_index = int(np.clip(np.floor(self.vehicle.energy_left / energy_step), 0, energy_bins - 1))
+            choice = back_pointers[i, velocity_index, energy_index]
+            policy[i] = self.possible_output_power_values(incline_angle, mu, (sin_angles[i], cos_angles[i]))[choice]
+            self.vehicle.output_power = policy[i]
+            new_velocity, new_energy, delta_t = self.calculate_next_state(incline_angle, policy[i], mu,
+                                                                          (gravity_forces[i], friction_forces[i]),
+                                                                          step_distances[i])
+            self.record_state(new_velocity, new_energy, delta_t, policy[i], step_distances[i])
+            if instrumentation is not None:
+                clamp_max += new_velocity >= self.vehicle.velocity_max
+                clamp_min += new_velocity <= self.min_velocity
+                instrumentation.step(self, i)
+
+        if instrumentation is not None:
+            instrumentation.add_time('dp_forward', perf_counter() - backward_end, N)
+            instrumentation.count('rollouts')
+            instrumentation.count('steps', N)
+            instrumentation.count('velocity_clamp_max', int(clamp_max))
+            instrumentation.count('velocity_clamp_min', int(clamp_min))
+            if self.vehicle.energy_left < 2:
+                instrumentation.count('energy_exhausted')
 
         # Store the policy
         self.policy = policy
@@ -164,24 +248,95 @@ class Simulation:
         # Return policy as it might be needed elsewhere
         return policy
 
-        
-    def calculate_next_state(self, incline_angle, output_power, mu):
-        rad_angle = np.radians(incline_angle)  # Convert angle to radians
-        # Calculate forces based on current vehicle state
-        gravity_force = self.vehicle.mass * self.g * np.sin(rad_angle)
-        friction_force = self.vehicle.mass * self.g * np.cos(rad_angle) * mu
-        drag_force = self.C_d * self.A * self.vehicle.velocity ** 2 / 2
-        # Calculate acceleration and new velocity without updating vehicle state
-        total_force = output_power / self.vehicle.velocity - gravity_force - friction_force - drag_force
-        acceleration = total_force / self.vehicle.mass
-        delta_v = acceleration * (self.distance_step / max(self.vehicle.velocity, self.min_velocity))
-        new_velocity = max(min(self.vehicle.velocity + delta_v, self.vehicle.velocity_max), self.min_velocity)
-        # Calculate new energy and cost time
-        power_consumed = output_power * (self.distance_step / max(self.vehicle.velocity, self.min_velocity))
-        power_regenerated = -0.740 * self.vehicle.velocity * (self.distance_step / max(self.vehicle.velocity, self.min_velocity))
-        new_energy = max(self.vehicle.energy_left - power_consumed + power_regenerated, 0)
-        delta_t = self.distance_step / max(self.vehicle.velocity, self.min_velocity)
-        return new_velocity, new_energy, delta_t
+    @staticmethod
+    def _interpolate_cost(J, velocity, energy, velocity_grid, energy_grid):
+        """
+        Bilinear interpolation of the cost-to-go grid J over the feasible (finite) neighbours, the
+        weights being renormalized. Infinite only when no feasible neighbour has a weight.
+        """
+        velocity_bins, energy_bins = J.shape
+        v_pos = np.clip((velocity - velocity_grid[0]) / (velocity_grid[1] - velocity_grid[0]), 0, velocity_bins - 1)
+        e_pos = np.clip((energy - energy_grid[0]) / (energy_grid[1] - energy_grid[0]), 0, energy_bins - 1)
+        v_low = np.minimum(v_pos.astype(np.intp), velocity_bins - 2)
+        e_low = np.minimum(e_pos.astype(np.intp), energy_bins - 2)
+        v_weight = v_pos - v_low
+        e_weight = e_pos - e_low
+
+        feasible = np.isfinite(J).ravel()
+        J_flat = np.where(feasible, J.ravel(), 0.0)
+        index = v_low * energy_bins + e_low
+        cost = np.zeros(np.shape(index))
+        weight_sum = np.zeros(np.shape(index))
+        for offset, weight in ((0, (1 - v_weight) * (1 - e_weight)), (1, (1 - v_weight) * e_weight),
+                               (energy_bins, v_weight * (1 - e_weight)), (energy_bins + 1, v_weight * e_weight)):
+            weight = weight * feasible.take(index + offset)
+            cost += weight * J_flat.take(index + offset)
+            weight_sum += weight
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(weight_sum > 0, cost / weight_sum, np.inf)
+
+    def transition(self, velocity, energy, incline_angle, output_power, mu, clamp_energy=True, road_forces=None,
+                   distance_step=None):
+        """
+        Next state of calculate_next_state for arrays of velocities, energies and powers.
+
+        Parameters:
+            velocity, energy, output_power (float or ndarray): Broadcastable current state and control.
+            incline_angle (float): Incline angle of the sub-segment in degrees.
+            mu (float): Friction coefficient of the sub-segment.
+            clamp_energy (bool): If False the new energy is not floored at 0, negative values
+                                 then mark transitions that need more energy than is left.
+            road_forces (tuple): Optional (gravity, friction) forces of the sub-segment, precomputed by Route.
+            distance_step (float): Length of the step, default is self.distance_step.
+
+        Returns:
+            tuple: (new_velocity, new_energy, delta_t)
+        """
+        if distance_step is None:
+            distance_step = self.distance_step
+        if road_forces is None:
+            road_forces = self.physics.road_forces(incline_angle, mu)
+        step = self.velocity_transition(velocity, output_power, *road_forces, distance_step)
+        return self.energy_transition(energy, step, clamp_energy)
+
+    def velocity_transition(self, velocity, output_power, gravity_force, friction_force, distance_step):
+        """
+        The part of transition that does not depend on the energy left, see PhysicsModel.transition.
+
+        Returns:
+            tuple: (new_velocity, power_consumed, power_regenerated, delta_t)
+        """
+        return self.physics.transition(velocity, output_power, gravity_force, friction_force, distance_step)
+
+    energy_transition = staticmethod(PhysicsModel.energy_transition)
+
+    def calculate_next_state(self, incline_angle, output_power, mu, road_forces=None, distance_step=None):
+        if self.transition_cache is None:
+            return self.transition(self.vehicle.velocity, self.vehicle.energy_left, incline_angle, output_power, mu,
+                                   road_forces=road_forces, distance_step=distance_step)
+
+        # The energy independent part of the step comes from the cache
+        if distance_step is None:
+            distance_step = self.distance_step
+        if road_forces is None:
+            road_forces = self.physics.road_forces(incline_angle, mu)
+        velocity = self.transition_cache.quantize(self.vehicle.velocity)
+        step = self.transition_cache.get(
+            (velocity, incline_angle, mu, distance_step, float(output_power)),
+            lambda: self.velocity_transition(velocity, output_power, *road_forces, distance_step))
+        return self.energy_transition(self.vehicle.energy_left, step)
+
+    def record_state(self, new_velocity, new_energy, delta_t, output_power, distance_step=None):
+        """Moves the vehicle to the given state after one distance step and appends it to the state lists."""
+        if distance_step is None:
+            distance_step = self.distance_step
+        new_distance = self.vehicle.covered_distance + distance_step
+        self.vehicle.update_velocity(new_velocity)
+        self.vehicle.energy_left = new_energy
+        self.vehicle.covered_distance = new_distance
+
+        self.trajectory.append(self.trajectory.latest('time') + delta_t, new_distance, new_velocity, new_energy,
+                               output_power / 1000)  # Convert watts to kilowatts for recording
 
     # You would call this method in your simulate method instead of the backward_pass and forward_pass
     def simulate(self):
@@ -189,32 +344,13 @@ class Simulation:
         self.plot_results()
 
 
-    def plot_results(self):
-        plt.figure(figsize=(12, 8))
-
-        plt.subplot(4, 1, 1)
-        plt.plot(self.distance_list, self.time_list, label='Time (s)')
-        plt.xlabel('Distance (m)')
-        plt.ylabel('Time (s)')
-        plt.legend()
-
-        plt.subplot(4, 1, 2)
-        plt.stem(self.distance_list, self.output_power_list, label='Power Output (kW)')
-        plt.xlabel('Distance (m)')
-        plt.ylabel('Power Output (W)')
-        plt.legend()
-
-        plt.subplot(4, 1, 3)
-        plt.plot(self.distance_list, self.velocity_list, label='Velocity (km/h)')
-        plt.xlabel('Distance (m)')
-        plt.ylabel('Velocity (m/s)')
-        plt.legend()
-
-        plt.subplot(4, 1, 4)
-        plt.plot(self.distance_list, self.energy_list, label='Energy (kJ)')
-        plt.xlabel('Distance (m)')
-        plt.ylabel('Energy (J)')
-        plt.legend()
-
-        plt.tight_layout()
-        plt.show()
+    def plot_results(self, path=None):
+        """
+        Plots the recorded time, output power, velocity and energy against the distance, see
+        plotting.plot_trajectory. With a path the figure is written to the file instead of shown.
+        """
+        return plot_trajectory(self.trajectory, path=path, distance_label='Distance (m)',
+                               panels=(('time', 'Time (s)', 'Time (s)'),
+                                       ('output_power', 'Power Output (kW)', 'Power Output (W)'),
+                                       ('velocity', 'Velocity (km/h)', 'Velocity (m/s)'),
+                                       ('energy', 'Energy (kJ)', 'Energy (J)')))
@@ -0,0 +1,206 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+from physics import describe_regeneration
+from route import Route
+
+# Vehicle fields and Simulation constants a solution depends on, in the order of the feature vectors
+VEHICLE_FIELDS = ('mass', 'frontal_area', 'velocity', 'energy_left', 'velocity_max', 'energy_max', 'output_power',
+                  'covered_distance')
+SIMULATION_FIELDS = ('g', 'C_d', 'eta', 'min_velocity', 'distance_step')
+
+
+class SolutionStore:
+    def __init__(self, directory, max_bytes=256 * 2 ** 20):
+        """
+        Persistent content-addressed store of solved route/vehicle configurations.
+
+        A configuration is addressed by the SHA-256 of the route segments and delta_s, the fields of
+        the vehicle at the start and the constants of the simulation. Each solution is a compressed
+        .npz file holding its schedule of candidate indices, its time, the trajectory arrays and the
+        full description of its configuration. The index.json file only keeps the size, number of
+        sub-segments, numeric features and route digest of every entry, so that it stays small
+        whatever the length of the routes. The last use of a solution is the modification time of
+        its .npz file: when the store grows over max_bytes, the least recently used solutions are
+        evicted.
+
+        Parameters:
+            directory (str): Folder of the store, created if needed.
+            max_bytes (int): Size of the .npz files above which the store evicts.
+        """
+        if max_bytes <= 0:
+            raise ValueError("Maximum size must be positive.")
+
+        self.directory = directory
+        self.max_bytes = max_bytes
+        os.makedirs(directory, exist_ok=True)
+        self.index_path = os.path.join(directory, 'index.json')
+        self.index = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+
+    @staticmethod
+    def describe(simulation):
+        """
+        Content a solution depends on, as a JSON compatible dictionary.
+
+        The vehicle is described by its state at the construction of the simulation, so the key
+        is the same before and after a run.
+        """
+        route = simulation.route
+        return {'segments': np.asarray(route.segments, dtype=float).tolist(),
+                'delta_s': np.asarray(route.delta_s, dtype=float).tolist(),
+                'vehicle': [float(getattr(simulation.initial_vehicle, field)) for field in VEHICLE_FIELDS],
+                'simulation': [None if getattr(simulation, field) is None else float(getattr(simulation, field))
+                               for field in SIMULATION_FIELDS],
+                'model': type(simulation).__module__,
+                'regeneration': describe_regeneration(simulation.physics.regeneration)}
+
+    @staticmethod
+    def _digest(content):
+        return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+    @staticmethod
+    def _features(description):
+        """Vehicle fields and simulation constants of a description, None for an unset constant."""
+        return description['vehicle'] + description['simulation']
+
+    def key(self, simulation):
+        """Content address of the configuration of simulation."""
+        return self._digest(self.describe(simulation))
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + '.npz')
+
+    def _save_index(self):
+        temporary = self.index_path + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(temporary, self.index_path)
+
+    def put(self, simulation, choices, solution_time, **extra):
+        """
+        Stores the solution of the configuration of simulation, replacing any previous one.
+
+        Parameters:
+            simulation (Simulation): The configuration, its trajectory holds the trace of the solution.
+            choices (ndarray of int): Candidate index used on each sub-segment.
+            solution_time (float): Time of the solution.
+            **extra: Additional arrays stored with the solution (e.g. output_power).
+
+        Returns:
+            str: The key of the solution.
+        """
+        description = self.describe(simulation)
+        key = self._digest(description)
+        path = self._path(key)
+        np.savez_compressed(path, choices=np.asarray(choices, dtype=np.int8), time=float(solution_time),
+                            trajectory=simulation.trajectory.arrays(), description=json.dumps(description),
+                            **extra)
+        self.index[key] = {'size': os.path.getsize(path),
+                           'time': float(solution_time),
+                           'n_steps': len(simulation.route),
+                           'model': description['model'],
+                           'features': self._features(description),
+                           'route': self._digest([description['segments'], description['delta_s']])}
+        self._evict(keep=key)
+        return key
+
+    def get(self, simulation):
+        """
+        Returns the solution of the configuration of simulation, None if it is not stored.
+
+        Returns:
+            dict: 'key', 'choices', 'time', 'trajectory' (shape (5, steps), the fields of
+                  Trajectory) and the extra arrays given to put.
+        """
+        key = self.key(simulation)
+        if key not in self.index or not os.path.exists(self._path(key)):
+            return None
+        return self._load(key)
+
+    def _load(self, key):
+        path = self._path(key)
+        with np.load(path) as data:
+            solution = {name: data[name] for name in data.files if name != 'description'}
+        solution['time'] = float(solution['time'])
+        solution['key'] = key
+        # The modification time of the file records the last use, the index is left untouched
+        os.utime(path)
+        return solution
+
+    def _description(self, key):
+        """Full description of a stored configuration, read from its .npz file."""
+        with np.load(self._path(key)) as data:
+            return json.loads(str(data['description']))
+
+    def _used(self, key):
+        path = self._path(key)
+        return os.path.getmtime(path) if os.path.exists(path) else -np.inf
+
+    def nearest(self, simulation):
+        """
+        Returns the stored solution closest to the configuration of simulation, None if no solution
+        has the same number of sub-segments.
+
+        The distance sums the relative differences of the vehicle fields and simulation constants,
+        and the differences of the per sub-segment angles and friction coefficients of the routes.
+        An exact match is returned as is.
+        """
+        description = self.describe(simulation)
+        exact = self._digest(description)
+        if exact in self.index and os.path.exists(self._path(exact)):
+            return self._load(exact)
+
+        route = simulation.route
+        route_digest = self._digest([description['segments'], description['delta_s']])
+        features = np.array(self._features(description), dtype=float)
+        best_key, best_distance = None, np.inf
+        for key, entry in self.index.items():
+            if entry['n_steps'] != len(route) or entry['model'] != description['model']:
+                continue
+            other_features = np.array(entry['features'], dtype=float)
+            scale = np.maximum(np.abs(features), np.abs(other_features))
+            relative = np.where(scale > 0, np.abs(features - other_features) / np.where(scale > 0, scale, 1), 0)
+            distance = float(np.nansum(relative))
+            if entry['route'] != route_digest:
+                if distance >= best_distance or not os.path.exists(self._path(key)):
+                    continue
+                other = self._description(key)
+                other_route = Route(other['segments'], delta_s=other['delta_s'])
+                distance += float(np.mean(np.abs(np.radians(other_route.angle_array - route.angle_array))
+                                          + np.abs(other_route.mu_array - route.mu_array)))
+            if distance < best_distance:
+                best_key, best_distance = key, distance
+        if best_key is None or not os.path.exists(self._path(best_key)):
+            return None
+        solution = self._load(best_key)
+        solution['distance'] = best_distance
+        return solution
+
+    def _evict(self, keep=None):
+        """Removes the least recently used solutions until the store fits in max_bytes."""
+        total = sum(entry['size'] for entry in self.index.values())
+        for key in sorted(self.index, key=self._used):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            total -= self.index.pop(key)['size']
+            if os.path.exists(self._path(key)):
+                os.remove(self._path(key))
+        self._save_index()
+
+    def size(self):
+        """Total size of the stored solutions in bytes."""
+        return sum(entry['size'] for entry in self.index.values())
+
+    def __contains__(self, simulation):
+        return self.key(simulation) in self.index
+
+    def __len__(self):
+        return len(self.index)
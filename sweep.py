@@ -0,0 +1,196 @@
+import copy
+import hashlib
+import itertools
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from physics import describe_regeneration
+from simulation import Simulation
+from vehicle import Vehicle
+
+# Swept parameters, the first three are Vehicle fields and the last two Simulation constants
+PARAMETERS = ('mass', 'frontal_area', 'energy_max', 'drag_coefficient', 'efficiency')
+# Swept parameters the model does not use: Simulation keeps efficiency as eta only
+INERT_PARAMETERS = ('efficiency',)
+# Simulation arguments the batch rollouts of the sweep do not use, left out of the keys
+OBSERVERS = ('rng', 'transition_cache', 'instrumentation')
+
+
+def pareto_front(times, energies):
+    """
+    Indices of the points not dominated in time and energy, by increasing time.
+
+    A point is dominated when another one is at least as fast and uses at most as much energy,
+    being strictly better on one of the two.
+    """
+    times = np.asarray(times, dtype=float)
+    energies = np.asarray(energies, dtype=float)
+    order = np.lexsort((energies, times))
+    front = []
+    lowest = np.inf
+    for i in order:
+        if energies[i] < lowest:
+            front.append(i)
+            lowest = energies[i]
+    return np.array(front, dtype=np.intp)
+
+
+def configuration_key(configuration, route, n_rollouts, vehicle_kwargs, simulation_kwargs):
+    """
+    Hash of everything a sweep result depends on but the seed, identical configurations share it.
+
+    The INERT_PARAMETERS and the OBSERVERS are left out, configurations that only differ by them
+    give the same result.
+    """
+    # The regeneration model is an object, it is hashed through its description
+    simulation_kwargs = {name: value for name, value in simulation_kwargs.items() if name not in OBSERVERS}
+    simulation_kwargs['regeneration'] = describe_regeneration(simulation_kwargs.get('regeneration'))
+    content = {'configuration': {name: value for name, value in configuration.items()
+                                 if name not in INERT_PARAMETERS},
+               'segments': np.asarray(route.segments, dtype=float).tolist(),
+               'delta_s': np.asarray(route.delta_s, dtype=float).tolist(),
+               'n_rollouts': n_rollouts,
+               'vehicle': vehicle_kwargs,
+               'simulation': simulation_kwargs}
+    return hashlib.sha256(json.dumps(content, sort_keys=True).encode()).hexdigest()
+
+
+def _solve_configuration(configuration, route, n_rollouts, seed, batch_size, vehicle_kwargs, simulation_kwargs):
+    """
+    Time/energy Pareto front of the random search for one configuration.
+
+    The vehicle starts full (energy_left = energy_max). Every batch of rollouts is merged into the
+    front, so the memory does not grow with n_rollouts.
+    """
+    vehicle = Vehicle(mass=configuration['mass'], frontal_area=configuration['frontal_area'],
+                      energy_left=configuration['energy_max'], energy_max=configuration['energy_max'], **vehicle_kwargs)
+    sim = Simulation(vehicle, route, drag_coefficient=configuration['drag_coefficient'],
+                     efficiency=configuration['efficiency'], **simulation_kwargs)
+    rng = np.random.default_rng(seed)
+    n_steps = len(route)
+
+    times = np.empty(0)
+    energies = np.empty(0)
+    choices = np.empty((0, n_steps), dtype=np.int8)
+    n_complete = 0
+    for start in range(0, n_rollouts, batch_size):
+        batch_choices = rng.integers(0, 4, size=(min(batch_size, n_rollouts - start), n_steps), dtype=np.int8)
+        result = sim._batch_rollout(batch_choices)
+        complete = result['steps'] == n_steps
+        n_complete += int(complete.sum())
+
+        times = np.concatenate([times, result['time'][complete]])
+        energies = np.concatenate([energies, vehicle.energy_left - result['energy'][complete]])
+        choices = np.concatenate([choices, batch_choices[complete]])
+        front = pareto_front(times, energies)
+        times, energies, choices = times[front], energies[front], choices[front]
+
+    return {'configuration': configuration,
+            'time': times.tolist(),
+            'energy': energies.tolist(),
+            'choices': choices.tolist(),
+            'n_complete': n_complete}
+
+
+def _load_cache(cache):
+    if isinstance(cache, str):
+        if os.path.exists(cache):
+            with open(cache) as f:
+                return json.load(f)
+        return {}
+    return {} if cache is None else cache
+
+
+def _save_cache(cache, entries):
+    if isinstance(cache, str):
+        temporary = cache + '.tmp'
+        with open(temporary, 'w') as f:
+            json.dump(entries, f)
+        os.replace(temporary, cache)
+
+
+def parameter_sweep(route, mass=(18000,), frontal_area=(8.16,), energy_max=(15000,), drag_coefficient=(0.6,),
+                    efficiency=(0.86,), n_rollouts=10000, seed=0, n_workers=None, batch_size=10000, cache=None,
+                    velocity_init=5, velocity_max=60, **simulation_kwargs):
+    """
+    Time/energy Pareto fronts over a grid of vehicle and battery parameters.
+
+    Every combination of the parameter grids is a configuration. Its front is made of the
+    complete rollouts of a random search that no other rollout beats both in time and in energy
+    used. Configurations are fanned out to worker processes, and identical ones, within the grid
+    or already in the cache, are only solved once. Each configuration draws from its own
+    generator seeded by seed and its key, so its front does not depend on the rest of the grid.
+    The efficiency is not used by the model: configurations differing only by it share one
+    result. A cached result is reused when it was solved with seed, or with any seed when seed
+    is None.
+
+    Parameters:
+        route (Route): The route driven by every configuration.
+        mass, frontal_area, energy_max (sequence of float): Grids of the Vehicle fields, the battery starts full.
+        drag_coefficient, efficiency (sequence of float): Grids of the Simulation constants.
+        n_rollouts (int): Rollouts of the random search of each configuration.
+        seed (int or None): Seed of the searches, None reuses cached results whatever their seed and
+                            draws a fresh one from the OS for the others.
+        n_workers (int or None): Number of processes, default is the number of cores. With 1 the
+                                 configurations are solved in the current process.
+        batch_size (int): Rollouts evaluated together.
+        cache (dict, str or None): Results by configuration key, or the path of a JSON file holding
+                                   them. New results are added to it.
+        velocity_init, velocity_max (float): Vehicle fields that are not swept.
+        **simulation_kwargs: Extra arguments of Simulation (distance_step, gravity, ...). A regeneration
+                             model is part of the keys, it needs a describe() method.
+
+    Returns:
+        list of dict: One result per configuration in grid order, with the 'configuration', its
+                      'key', the 'seed' it was solved with, the front 'time', 'energy' and 'choices' by increasing time,
+                      the number of complete rollouts 'n_complete' and 'cached', True when it came from
+                      the cache.
+    """
+    if n_rollouts <= 0:
+        raise ValueError("Number of rollouts must be positive.")
+
+    grids = (mass, frontal_area, energy_max, drag_coefficient, efficiency)
+    configurations = [dict(zip(PARAMETERS, map(float, values))) for values in itertools.product(*grids)]
+    vehicle_kwargs = {'velocity_init': velocity_init, 'velocity_max': velocity_max}
+    keys = [configuration_key(configuration, route, n_rollouts, vehicle_kwargs, simulation_kwargs)
+            for configuration in configurations]
+
+    entries = _load_cache(cache)
+    cached = {key for key in keys if key in entries and (seed is None or entries[key].get('seed') == seed)}
+    if seed is None:
+        seed = np.random.SeedSequence().entropy
+    tasks = {}
+    for key, configuration in zip(keys, configurations):
+        if key not in cached and key not in tasks:
+            tasks[key] = (configuration, route, n_rollouts, [seed, int(key[:16], 16)], batch_size,
+                          vehicle_kwargs, simulation_kwargs)
+
+    if n_workers == 1:
+        results = [_solve_configuration(*task) for task in tasks.values()]
+    elif tasks:
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            results = list(executor.map(_solve_configuration, *zip(*tasks.values())))
+    else:
+        results = []
+    entries.update((key, dict(result, seed=seed)) for key, result in zip(tasks, results))
+    if tasks:
+        _save_cache(cache, entries)
+
+    return [dict(copy.deepcopy(entries[key]), configuration=configuration, key=key, cached=key in cached)
+            for key, configuration in zip(keys, configurations)]
+
+
+if __name__ == "__main__":
+    from route import Route
+
+    rout = Route(((4, 5, 0.015), (2, -5, 0.015), (4, 5, 0.015)), delta_s=0.5)
+    start = time.perf_counter()
+    sweep = parameter_sweep(rout, mass=(16000, 18000, 20000), energy_max=(12000, 15000), n_rollouts=20000,
+                            distance_step=0.5)
+    for result in sweep:
+        print(result['configuration'], f"{len(result['time'])} points, fastest {min(result['time'], default=None)}")
+    print(f"{len(sweep)} configurations in {time.perf_counter() - start:.2f} s")
@@ -0,0 +1,495 @@
+import copy
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+import simulation_cp
+from instrumentation import Instrumentation
+from mpc import MPCController
+from physics import BrakingRegeneration
+from plotting import decimate
+from pmp import PMPSolver
+from route import Route
+from search import cross_entropy_search, parallel_random_search
+from simulation import Simulation
+from store import SolutionStore
+from sweep import parameter_sweep
+from transition_cache import TransitionCache
+from vehicle import Vehicle
+
+ROUTES = {'flat': (((10, 0, 0.015),), 0.5),
+          'two_hills': (((4, 5, 0.015), (2, -5, 0.015), (4, 5, 0.015)), 0.5),
+          'mixed': (((30, 3, 0.015), (20, -7, 0.02), (15, 0, 0.01)), (0.25, 0.5, 0.1))}
+
+
+def reference_vehicle():
+    return Vehicle(mass=18000, frontal_area=8.16, velocity_init=5, energy_left=15000, velocity_max=60, energy_max=15000)
+
+
+class ScheduledSimulation(Simulation):
+    """Simulation whose power_strategy follows a schedule of candidate indices."""
+
+    def __init__(self, *args, choices, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.schedule = iter(choices)
+
+    def power_strategy(self, output_values):
+        return output_values[next(self.schedule)]
+
+
+def schedules(n_steps, n_schedules=5, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.integers(0, 4, size=(n_schedules, n_steps))
+
+
+def test_route_keeps_partial_sub_segments():
+    route = Route(((10, 0, 0.015),), delta_s=0.3)
+    assert len(route) == 34
+    assert np.allclose(route.step_array[:-1], 0.3) and np.isclose(route.step_array[-1], 0.1)
+    assert np.isclose(route.distance_array[-1], 10)
+    # A full step of the simulation covers delta_s, the final one its share
+    assert np.allclose(route.step_distances(0.5)[:-1], 0.5) and np.isclose(route.step_distances(0.5)[-1], 0.5 / 3)
+    assert route.step_distances() is route.step_array
+
+    # Lengths that are multiples of delta_s up to the floating point error give no sliver
+    assert np.allclose(Route(((0.3, 0, 0.015),), delta_s=0.1).step_array, 0.1)
+    assert len(Route(((0.3, 0, 0.015),), delta_s=0.1)) == 3
+
+
+def test_route_takes_one_delta_s_per_segment():
+    route = Route(((1, 2, 0.01), (1, -3, 0.02)), delta_s=(0.5, 0.25))
+    assert np.allclose(route.step_array, [0.5] * 2 + [0.25] * 4)
+    assert np.array_equal(route.segment_index_array, [0, 0, 1, 1, 1, 1])
+    assert np.array_equal(route.angle_array, [2] * 2 + [-3] * 4)
+    assert np.allclose(route.step_distances(1), 1)
+    with pytest.raises(ValueError):
+        Route(((1, 0, 0.01),), delta_s=0)
+
+
+@pytest.mark.parametrize('header', (False, True))
+def test_route_from_file(tmp_path, header):
+    path = tmp_path / 'profile.csv'
+    path.write_text(('distance,altitude,mu\n' if header else '') + '0,0,0.01\n3,0,0.02\n8,3,0.03\n')
+    route = Route.from_file(str(path), delta_s=1)
+    assert len(route) == 8
+    assert np.allclose(route.mu_array, [0.01] * 3 + [0.02] * 5)
+    assert np.allclose(route.angle_array, [0] * 3 + [np.degrees(np.arcsin(3 / 5))] * 5)
+
+    path.write_text(('distance,altitude\n' if header else '') + '0,0\n3,0\n8,3\n')
+    assert np.allclose(Route.from_file(str(path), mu=0.05, delta_s=1).mu_array, 0.05)
+
+    np.save(tmp_path / 'profile.npy', np.array([[0, 0], [3, 0], [8, 3]]))
+    assert np.array_equal(Route.from_file(str(tmp_path / 'profile.npy'), delta_s=1).angle_array, route.angle_array)
+
+
+def test_route_keeps_the_latest_road_forces():
+    route = Route(*ROUTES['mixed'])
+    forces = route.road_forces(18000, 9.81)
+    for mass in range(10000, 10000 + 10 * Route.road_forces_maxsize, 10):
+        route.road_forces(mass, 9.81)
+    assert len(route._road_forces) == Route.road_forces_maxsize
+    again = route.road_forces(18000, 9.81)
+    assert again is not forces and all(np.array_equal(a, b) for a, b in zip(again, forces))
+    assert route.road_forces(18000, 9.81) is again
+
+
+def test_route_from_profile_checks_the_distances():
+    with pytest.raises(ValueError):
+        Route.from_profile([0, 2, 1], [0, 0, 0])
+    with pytest.raises(ValueError):
+        Route.from_profile([0], [0])
+
+
+@pytest.mark.parametrize('name', ROUTES)
+def test_batch_and_kernels_match_simulate(name):
+    segments, delta_s = ROUTES[name]
+    route = Route(segments, delta_s=delta_s)
+    for choices in schedules(len(route)):
+        sim = ScheduledSimulation(reference_vehicle(), route, distance_step=None, choices=choices)
+        sim.simulate()
+        expected = sim.trajectory.arrays()
+
+        batch = Simulation(reference_vehicle(), route, distance_step=None)
+        traces = batch._batch_rollout(choices[None, :], record=True)['traces']
+        batch_traces = np.array([traces[field][0, :expected.shape[1]] for field in sim.trajectory.fields])
+        assert np.array_equal(batch_traces, expected)
+
+        kernel = Simulation(reference_vehicle(), route, distance_step=None, backend='interpreted')
+        kernel.simulate_kernel(choices)
+        assert np.array_equal(kernel.trajectory.arrays(), expected)
+
+
+@pytest.mark.parametrize('name', ROUTES)
+def test_numba_kernel_matches_simulate(name):
+    # Without Numba the 'numba' backend falls back to the interpreted kernel, the check would not run
+    pytest.importorskip('numba')
+    route = Route(*ROUTES[name])
+    for choices in schedules(len(route)):
+        sim = ScheduledSimulation(reference_vehicle(), route, distance_step=None, choices=choices)
+        sim.simulate()
+        kernel = Simulation(reference_vehicle(), route, distance_step=None, backend='numba')
+        kernel.simulate_kernel(choices)
+        assert np.array_equal(kernel.trajectory.arrays(), sim.trajectory.arrays())
+
+
+def test_chunks_match_simulate():
+    segments, delta_s = ROUTES['two_hills']
+    route = Route(segments, delta_s=delta_s)
+    choices = schedules(len(route), 1)[0]
+    sim = ScheduledSimulation(reference_vehicle(), route, distance_step=None, choices=choices)
+    sim.simulate()
+
+    chunked = Simulation(reference_vehicle(), route, distance_step=None)
+    blocks = list(chunked.simulate_chunks(chunk_size=7, choices=choices))
+    assert np.array_equal(np.concatenate(blocks, axis=1), sim.trajectory.arrays()[:, 1:])
+
+
+def test_dynamic_programming_stays_feasible_on_long_routes():
+    route = Route(((400, 5, 0.015), (200, -5, 0.015), (400, 5, 0.015)), delta_s=0.5)
+    sim = simulation_cp.Simulation(reference_vehicle(), route, distance_step=0.5)
+    sim.dynamic_programming_approach()
+
+    assert len(route) == 2000
+    assert np.isfinite(sim.expected_time)
+    # The grid cost-to-go and the replayed schedule differ by the interpolation error only
+    assert abs(sim.expected_time - sim.time_list[-1]) < 0.05 * sim.time_list[-1]
+    assert sim.energy_list[-1] >= 0
+
+
+def test_pmp_beats_random_search():
+    segments, delta_s = ROUTES['two_hills']
+    result = PMPSolver(reference_vehicle(), Route(segments, delta_s=delta_s), distance_step=delta_s).solve()
+    # Best of one million random rollouts, parallel_random_search(seed=2024)
+    assert result['time'] <= 2801.1
+    assert np.isclose(result['simulation'].time_list[-1], result['time'])
+    # One rollout per shooting iteration, the needle variations come on top, within their window
+    assert result['iterations'] < result['n_rollouts'] <= result['iterations'] + 10 * 3 * len(result['choices'])
+
+
+def test_pmp_uses_the_regeneration_model():
+    segments, delta_s = ROUTES['two_hills']
+    regeneration = BrakingRegeneration()
+    result = PMPSolver(reference_vehicle(), Route(segments, delta_s=delta_s), distance_step=delta_s,
+                       regeneration=regeneration).solve()
+    assert result['simulation'].physics.regeneration is regeneration
+    assert np.isclose(result['simulation'].time_list[-1], result['time'])
+
+
+def test_chunks_keep_the_trajectory():
+    segments, delta_s = ROUTES['two_hills']
+    route = Route(segments, delta_s=delta_s)
+    sim = Simulation(reference_vehicle(), route, distance_step=None, record_every=3)
+    trajectory = sim.trajectory
+    blocks = list(sim.simulate_chunks(chunk_size=7, choices=schedules(len(route), 1)[0]))
+
+    assert sim.trajectory is trajectory and sim.trajectory.record_every == 3
+    assert np.array_equal(sim.trajectory.arrays()[:, -1], blocks[-1][:, -1])
+    assert sim.trajectory.arrays()[2, 0] == 5
+
+
+def test_cache_keys_depend_on_the_regeneration():
+    route = Route(*ROUTES['flat'])
+    results = [parameter_sweep(route, n_rollouts=100, n_workers=1, regeneration=regeneration)[0]
+               for regeneration in (None, BrakingRegeneration(), BrakingRegeneration(efficiency=0.3))]
+    assert len({result['key'] for result in results}) == 3
+
+    descriptions = [SolutionStore.describe(Simulation(reference_vehicle(), route, regeneration=regeneration))
+                    for regeneration in (None, BrakingRegeneration(), BrakingRegeneration(efficiency=0.3))]
+    assert len({json.dumps(description, sort_keys=True) for description in descriptions}) == 3
+
+    # A plain function does not describe its parameters, it cannot be keyed
+    with pytest.raises(ValueError):
+        parameter_sweep(route, n_rollouts=100, n_workers=1, regeneration=lambda v, p, r: -0.5 * v)
+    with pytest.raises(ValueError):
+        SolutionStore.describe(Simulation(reference_vehicle(), route, regeneration=lambda v, p, r: -0.5 * v))
+
+
+def test_simulate_kernel_from_the_python_backend():
+    route = Route(*ROUTES['two_hills'])
+    choices = schedules(len(route), 1)[0]
+    sim = ScheduledSimulation(reference_vehicle(), route, distance_step=None, choices=choices)
+    sim.simulate()
+    kernel = Simulation(reference_vehicle(), route, distance_step=None)
+    kernel.simulate_kernel(choices)
+    assert np.array_equal(kernel.trajectory.arrays(), sim.trajectory.arrays())
+
+
+def test_store_key_is_stable_across_runs(tmp_path):
+    route = Route(*ROUTES['two_hills'])
+    sim = Simulation(reference_vehicle(), route, distance_step=None)
+    store = SolutionStore(str(tmp_path))
+    key = store.key(sim)
+    sim.simulate_kernel(schedules(len(route), 1)[0])
+    assert store.key(sim) == key
+
+
+def test_transition_cache_evaluates_the_driven_transitions_only():
+    route = Route(*ROUTES['mixed'])
+    runs = []
+    for cache in (None, TransitionCache()):
+        sim = Simulation(reference_vehicle(), route, distance_step=None, rng=np.random.default_rng(3),
+                         transition_cache=cache)
+        sim.simulate()
+        runs.append(sim.trajectory.arrays())
+    assert np.array_equal(runs[0], runs[1])
+    assert cache.misses + cache.hits == runs[1].shape[1] - 1
+
+
+def test_mpc_out_of_time_follows_the_warm_plan():
+    route = Route(*ROUTES['two_hills'])
+    controller = MPCController(simulation_cp.Simulation(reference_vehicle(), route, distance_step=0.5),
+                               latency_budget=1e-9)
+    policy = controller.run()
+    assert len(policy) == len(route)
+    assert controller.latency_stats()['depth'] == 0
+
+
+def test_mpc_stays_close_to_dynamic_programming():
+    route = Route(*ROUTES['two_hills'])
+    reference = simulation_cp.Simulation(reference_vehicle(), route, distance_step=0.5)
+    reference.dynamic_programming_approach()
+    controller = MPCController(simulation_cp.Simulation(reference_vehicle(), route, distance_step=0.5))
+    controller.run()
+
+    stats = controller.latency_stats()
+    assert stats['decisions'] == len(route) and stats['depth'] > 0
+    assert 0 < stats['p50'] <= stats['p99'] <= stats['max']
+    assert controller.simulation.time_list[-1] <= 1.02 * reference.time_list[-1]
+
+
+def test_sweep_draws_a_seed_when_none_is_given():
+    route = Route(*ROUTES['flat'])
+    result = parameter_sweep(route, n_rollouts=100, n_workers=1, seed=None)[0]
+    again = parameter_sweep(route, n_rollouts=100, n_workers=1, seed=result['seed'])[0]
+    assert np.array_equal(result['time'], again['time'])
+
+
+def stored_simulation(route, choices, **vehicle_fields):
+    vehicle = reference_vehicle()
+    for field, value in vehicle_fields.items():
+        setattr(vehicle, field, value)
+    query = Simulation(copy.deepcopy(vehicle), route, distance_step=None)
+    sim = Simulation(vehicle, route, distance_step=None)
+    sim.simulate_kernel(choices)
+    return query, sim
+
+
+def test_store_put_get_and_nearest(tmp_path):
+    route = Route(*ROUTES['two_hills'])
+    choices = schedules(len(route), 1)[0]
+    query, solved = stored_simulation(route, choices)
+    store = SolutionStore(str(tmp_path))
+    assert store.get(query) is None and store.nearest(query) is None
+
+    key = store.put(solved, choices, solved.trajectory.last[2])
+    solution = SolutionStore(str(tmp_path)).get(query)
+    assert solution['key'] == key and query in store
+    assert np.array_equal(solution['choices'], choices)
+    assert np.array_equal(solution['trajectory'], solved.trajectory.arrays())
+    assert solution['time'] == solved.trajectory.last[2]
+
+    # The index only holds fixed size entries, the description lives in the .npz file
+    with open(tmp_path / 'index.json') as f:
+        assert 'segments' not in f.read()
+
+    heavier, _ = stored_simulation(route, choices, mass=19000)
+    nearest = store.nearest(heavier)
+    assert nearest['key'] == key and nearest['distance'] > 0
+    other_route = Route(((4, 4, 0.015), (2, -5, 0.015), (4, 5, 0.015)), delta_s=0.5)
+    assert store.nearest(stored_simulation(other_route, choices)[0])['key'] == key
+    assert store.nearest(stored_simulation(Route(((5, 0, 0.015),), 0.5), schedules(10, 1)[0])[0]) is None
+
+
+def test_store_evicts_the_least_recently_used(tmp_path):
+    route = Route(*ROUTES['two_hills'])
+    choices = schedules(len(route), 1)[0]
+    simulations = [stored_simulation(route, choices, mass=mass) for mass in (17000, 18000, 19000)]
+    store = SolutionStore(str(tmp_path))
+    keys = []
+    for i, (query, solved) in enumerate(simulations[:2]):
+        keys.append(store.put(solved, choices, solved.trajectory.last[2]))
+        os.utime(store._path(keys[-1]), (i, i))
+    store.get(simulations[0][0])
+
+    store.max_bytes = store.size() * 5 // 4
+    keys.append(store.put(simulations[2][1], choices, 0.0))
+    assert len(store) == 2 and keys[1] not in store.index
+    assert not os.path.exists(store._path(keys[1]))
+    assert SolutionStore(str(tmp_path)).get(simulations[0][0]) is not None
+
+
+def test_sweep_dedupes_the_efficiency_and_reuses_the_cache_without_seed(tmp_path):
+    route = Route(*ROUTES['flat'])
+    cache = str(tmp_path / 'sweep.json')
+    results = parameter_sweep(route, efficiency=(0.8, 0.9), n_rollouts=100, n_workers=1, seed=None, cache=cache)
+    assert results[0]['key'] == results[1]['key'] and results[0]['time'] == results[1]['time']
+    assert [result['configuration']['efficiency'] for result in results] == [0.8, 0.9]
+
+    again = parameter_sweep(route, efficiency=(0.86,), n_rollouts=100, n_workers=1, seed=None, cache=cache)[0]
+    assert again['cached'] and again['seed'] == results[0]['seed']
+    assert not parameter_sweep(route, n_rollouts=100, n_workers=1, seed=1, cache=cache)[0]['cached']
+
+
+def test_checkpoint_of_another_problem_is_refused(tmp_path):
+    checkpoint = str(tmp_path / 'search.json')
+    first = parallel_random_search(reference_vehicle(), Route(*ROUTES['two_hills']), 400, seed=1, n_workers=1,
+                                   n_shards=4, checkpoint=checkpoint, distance_step=0.5)
+    resumed = parallel_random_search(reference_vehicle(), Route(*ROUTES['two_hills']), 400, n_workers=1,
+                                     n_shards=4, checkpoint=checkpoint, distance_step=0.5)
+    assert resumed['time'] == first['time'] and resumed['seed'] == first['seed']
+    for route, kwargs in ((Route(*ROUTES['flat']), {'distance_step': 0.5}),
+                          (Route(*ROUTES['two_hills']), {'distance_step': 0.5, 'batch_size': 7}),
+                          (Route(*ROUTES['two_hills']), {'distance_step': 0.5, 'gravity': 9.8})):
+        with pytest.raises(ValueError):
+            parallel_random_search(reference_vehicle(), route, 400, n_workers=1, n_shards=4, checkpoint=checkpoint,
+                                   **kwargs)
+
+
+def test_cross_entropy_completes_long_routes():
+    route = Route(((400, 5, 0.015), (200, -5, 0.015), (400, 5, 0.015)), delta_s=0.5)
+    result = cross_entropy_search(reference_vehicle(), route, seed=0, distance_step=0.5)
+    assert len(route) == 2000
+    assert np.isfinite(result['time']) and result['converged']
+    assert np.isclose(result['simulation'].time_list[-1], result['time'])
+
+
+@pytest.mark.parametrize('cache', (False, True))
+def test_instrumentation_leaves_simulate_unchanged(cache):
+    route = Route(*ROUTES['mixed'])
+    visited = []
+    instrumentation = Instrumentation(callbacks=[lambda sim, step: visited.append(step)])
+    runs = []
+    for probe in (None, instrumentation):
+        sim = Simulation(reference_vehicle(), route, distance_step=None, rng=np.random.default_rng(3),
+                         transition_cache=TransitionCache() if cache else None, instrumentation=probe)
+        sim.simulate()
+        runs.append(sim.trajectory.arrays())
+    assert np.array_equal(runs[0], runs[1])
+
+    steps = runs[1].shape[1] - 1
+    counters = instrumentation.to_dict()['counters']
+    assert counters['rollouts'] == 1 and counters['steps'] == steps and visited == list(range(steps))
+    assert counters.get('energy_exhausted', 0) == int(steps < len(route))
+    assert set(instrumentation.timers) == {'strategy', 'physics', 'record', 'callbacks'}
+
+
+@pytest.mark.parametrize('spill_name', ('trace.npy', 'trace.bin'))
+@pytest.mark.parametrize('make_rng', (np.random.default_rng, np.random.RandomState))
+def test_resume_from_a_snapshot_matches_an_uninterrupted_run(tmp_path, spill_name, make_rng):
+    route = Route(*ROUTES['mixed'])
+
+    def full_vehicle():
+        return Vehicle(mass=18000, frontal_area=8.16, velocity_init=5, energy_left=1e7, velocity_max=60,
+                       energy_max=1e7)
+
+    expected_spill, spill = str(tmp_path / ('expected_' + spill_name)), str(tmp_path / spill_name)
+    expected = list(Simulation(full_vehicle(), route, distance_step=None, rng=make_rng(5))
+                    .simulate_chunks(chunk_size=16, spill=expected_spill))
+    assert len(expected) > 4
+
+    sim = Simulation(full_vehicle(), route, distance_step=None, rng=make_rng(5))
+    run = sim.simulate_chunks(chunk_size=16, spill=spill)
+    blocks = [next(run), next(run)]
+    sim.save_snapshot(str(tmp_path / 'snapshot.json'))
+    # The run goes on past the snapshot and dies, its extra rows must be dropped on resume
+    next(run), next(run)
+    run.close()
+
+    resumed = Simulation(full_vehicle(), route, distance_step=None, rng=make_rng(99))
+    resumed.load_snapshot(str(tmp_path / 'snapshot.json'))
+    assert resumed.step_index == 32
+    blocks += list(resumed.simulate_chunks(chunk_size=16, spill=spill))
+
+    assert len(blocks) == len(expected)
+    assert all(np.array_equal(block, other) for block, other in zip(blocks, expected))
+    if spill_name.endswith('.npy'):
+        assert np.array_equal(np.load(spill), np.load(expected_spill), equal_nan=True)
+    else:
+        with open(spill, 'rb') as f, open(expected_spill, 'rb') as g:
+            assert f.read() == g.read()
+
+
+def test_adaptive_matches_a_fine_fixed_step_run():
+    segments = ((100, 0, 0.015),)
+    vehicle = Vehicle(mass=18000, frontal_area=8.16, velocity_init=5, energy_left=1e7, velocity_max=60, energy_max=1e7)
+    sim = Simulation(copy.deepcopy(vehicle), Route(segments, delta_s=0.5), distance_step=None)
+    sim.simulate_adaptive(np.full(200, 2), tolerance=1e-6)
+    # The Euler steps of simulate, 100 times finer
+    fine = Simulation(copy.deepcopy(vehicle), Route(segments, delta_s=0.005), distance_step=None)
+    fine.simulate_kernel(np.full(20000, 2))
+    # What is left is the first order error of the Euler steps, mostly on the time
+    assert np.allclose(sim.trajectory.last, fine.trajectory.last, rtol=5e-5, atol=0)
+    assert np.allclose(sim.trajectory.last[2:4], fine.trajectory.last[2:4], rtol=2e-6, atol=0)
+
+
+def test_adaptive_takes_long_steps_on_constant_stretches():
+    vehicle = Vehicle(mass=18000, frontal_area=8.16, velocity_init=5, energy_left=1e7, velocity_max=60, energy_max=1e7)
+    route = Route(((1000, 0, 0.015),), delta_s=0.1)
+    integrator = Simulation(vehicle, route, distance_step=None).simulate_adaptive(np.full(len(route), 2))
+    assert 10 * integrator.n_steps < len(route)
+
+
+def test_adaptive_stops_where_the_energy_runs_out():
+    segments = ((10, 0, 0.015),)
+    sim = Simulation(reference_vehicle(), Route(segments, delta_s=0.5), distance_step=None)
+    sim.simulate_adaptive(np.full(20, 2))
+    energy, distance = sim.trajectory.energy, sim.trajectory.distance
+    assert 2 - 1e-3 < energy[-1] < 2 <= energy[-2]
+    assert distance[-1] < 10
+
+    fine = Simulation(reference_vehicle(), Route(segments, delta_s=0.005), distance_step=None)
+    fine.simulate_kernel(np.full(2000, 2))
+    assert abs(fine.trajectory.distance[-1] - distance[-1]) < 0.01
+
+
+def test_decimate_keeps_the_extrema_of_every_bin():
+    rng = np.random.default_rng(0)
+    x = np.arange(10000, dtype=float)
+    y = rng.normal(size=10000)
+    x_kept, y_kept = decimate(x, y, 50)
+    assert len(y_kept) <= 2 * 50 + 2
+    assert (x_kept[0], x_kept[-1]) == (0, 9999) and np.all(np.diff(x_kept) > 0)
+    assert np.array_equal(y[x_kept.astype(int)], y_kept)
+    # The 9998 interior points fall in 50 consecutive bins of 199 or 200 points
+    bins = np.arange(9998) * 50 // 9998
+    for b in range(50):
+        interior = y[1:-1][bins == b]
+        assert interior.min() in y_kept and interior.max() in y_kept
+    assert y.min() in y_kept and y.max() in y_kept
+
+    short_x, short_y = x[:102], y[:102]
+    assert all(a is b for a, b in zip(decimate(short_x, short_y, 50), (short_x, short_y)))
+
+
+def test_plot_results_renders_to_a_file(tmp_path):
+    pytest.importorskip('matplotlib')
+    sim = Simulation(reference_vehicle(), Route(*ROUTES['two_hills']), distance_step=None)
+    sim.simulate_kernel(schedules(len(sim.route), 1)[0])
+    figure = sim.plot_results(str(tmp_path / 'trajectory.png'))
+    assert len(figure.axes) == 4 and (tmp_path / 'trajectory.png').stat().st_size > 0
+
+
+def test_simulators_do_not_import_matplotlib():
+    code = "import sys, simulation, search, sweep; sys.exit('matplotlib' in sys.modules)"
+    assert subprocess.run([sys.executable, '-c', code], cwd=os.path.dirname(os.path.abspath(__file__))).returncode == 0
+
+
+def test_parallel_random_search_does_not_depend_on_the_workers():
+    route = Route(*ROUTES['two_hills'])
+    results = [parallel_random_search(reference_vehicle(), route, 2000, seed=7, n_workers=n_workers, n_shards=8,
+                                      batch_size=100, distance_step=0.5)
+               for n_workers in (1, 2)]
+    assert results[0]['time'] == results[1]['time'] and results[0]['shard'] == results[1]['shard']
+    assert np.array_equal(results[0]['choices'], results[1]['choices'])
+
+
+def test_sweep_accepts_instrumentation_and_transition_caches():
+    route = Route(*ROUTES['flat'])
+    plain = parameter_sweep(route, n_rollouts=100, n_workers=1)[0]
+    instrumented = parameter_sweep(route, n_rollouts=100, n_workers=1, instrumentation=Instrumentation(),
+                                   transition_cache=TransitionCache())[0]
+    assert instrumented['time'] == plain['time'] and instrumented['energy'] == plain['energy']
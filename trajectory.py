@@ -0,0 +1,162 @@
+import numpy as np
+
+
+class Trajectory:
+    fields = ('time', 'distance', 'velocity', 'energy', 'output_power')
+
+    def __init__(self, capacity, record_every=1):
+        """
+        Preallocated storage of the state recorded at each simulation step.
+
+        The five traces are the rows of one float64 buffer sized up front, steps are written
+        in place and the traces are exposed as views, without copies.
+
+        Parameters:
+            capacity (int): Expected number of steps, the buffer grows if more are recorded.
+            record_every (int or None): Keep one step out of record_every. With None only the
+                                        initial and the latest state are kept. The latest state
+                                        always ends the traces, whatever its step.
+        """
+        if record_every is not None and record_every < 1:
+            raise ValueError("record_every must be a positive integer or None.")
+
+        self.record_every = record_every
+        self.buffer = np.empty((len(self.fields), self._slots(capacity)))
+        self.size = 0      # Number of recorded columns
+        self.steps = 0     # Number of steps since the initial state
+        self.last = None   # Latest state, written at the end of the traces when it was not recorded
+
+    def _slots(self, capacity):
+        # The initial state, the recorded steps and a spare column for the latest state
+        if self.record_every is None:
+            return 2
+        return capacity // self.record_every + 2
+
+    def reset(self, time, distance, velocity, energy, output_power):
+        """Clears the traces and records the initial state."""
+        self.buffer[:, 0] = (time, distance, velocity, energy, output_power)
+        self.size = 1
+        self.steps = 0
+        self.last = self.buffer[:, 0].copy()
+
+    def append(self, time, distance, velocity, energy, output_power):
+        """Records the state after one more step."""
+        self.steps += 1
+        self.last[:] = (time, distance, velocity, energy, output_power)
+        if self.record_every is not None and self.steps % self.record_every == 0:
+            if self.size + 1 >= self.buffer.shape[1]:
+                self.buffer = np.concatenate([self.buffer, np.empty_like(self.buffer)], axis=1)
+            self.buffer[:, self.size] = self.last
+            self.size += 1
+
+    def load(self, time, distance, velocity, energy, output_power):
+        """Replaces the traces by full traces of one rollout, keeping the record_every sampling."""
+        traces = np.array([time, distance, velocity, energy, output_power], dtype=float)
+        self.steps = traces.shape[1] - 1
+        if self.record_every is None:
+            kept = traces[:, :1]
+        else:
+            kept = traces[:, ::self.record_every]
+        if self.buffer.shape[1] < kept.shape[1] + 1:
+            self.buffer = np.empty((len(self.fields), kept.shape[1] + 1))
+        self.buffer[:, :kept.shape[1]] = kept
+        self.size = kept.shape[1]
+        self.last = traces[:, -1].copy()
+
+    def latest(self, field):
+        """Latest value of a field, without building its trace."""
+        return self.last[self.fields.index(field)]
+
+    def arrays(self):
+        """Buffer view of shape (5, recorded steps), ending with the latest state."""
+        if self.size == 0:
+            return self.buffer[:, :0]
+        end = self.size
+        if self.steps % (self.record_every or self.steps + 1) != 0:
+            # The latest state was not recorded, put it in the spare column
+            self.buffer[:, end] = self.last
+            end += 1
+        return self.buffer[:, :end]
+
+    @property
+    def time(self):
+        return self.arrays()[0]
+
+    @property
+    def distance(self):
+        return self.arrays()[1]
+
+    @property
+    def velocity(self):
+        return self.arrays()[2]
+
+    @property
+    def energy(self):
+        return self.arrays()[3]
+
+    @property
+    def output_power(self):
+        return self.arrays()[4]
+
+    def __len__(self):
+        return self.arrays().shape[1]
+
+
+class TrajectoryWriter:
+    def __init__(self, path, capacity, resume_at=None):
+        """
+        Spills trajectory chunks to disk, one row of the five fields per step.
+
+        A .npy path is a memory-mapped array of shape (capacity, 5) preallocated with nan, the steps
+        not written yet stay nan. Any other path is an append-only file of raw float64 rows, read
+        back with np.fromfile(path).reshape(-1, 5).
+
+        Parameters:
+            path (str): Destination file.
+            capacity (int): Number of rows of a .npy file, the initial state and one per sub-segment.
+            resume_at (int or None): Opens an existing file to continue it from this row instead of
+                                     starting a new one. Rows written after it, e.g. by a run
+                                     that died after its last snapshot, are dropped.
+        """
+        self.path = path
+        self.memmap = path.endswith('.npy')
+        if self.memmap:
+            if resume_at is not None:
+                self.array = np.load(path, mmap_mode='r+')
+                self.array[resume_at:] = np.nan
+            else:
+                self.array = np.lib.format.open_memmap(path, mode='w+', shape=(capacity, len(Trajectory.fields)))
+                self.array[:] = np.nan
+            self.file = None
+        else:
+            self.array = None
+            if resume_at is None:
+                self.file = open(path, 'wb')
+            else:
+                self.file = open(path, 'r+b')
+                self.file.truncate(resume_at * len(Trajectory.fields) * 8)
+                self.file.seek(0, 2)
+
+    def write(self, start, chunk):
+        """
+        Writes a chunk of shape (5, steps) whose first column is the state after step start.
+
+        Append-only files ignore start, chunks must come in order.
+        """
+        rows = np.ascontiguousarray(np.asarray(chunk, dtype=float).T)
+        if self.memmap:
+            self.array[start:start + len(rows)] = rows
+        else:
+            self.file.write(rows.tobytes())
+
+    def flush(self):
+        if self.memmap:
+            self.array.flush()
+        else:
+            self.file.flush()
+
+    def close(self):
+        self.flush()
+        if self.file is not None:
+            self.file.close()
+        self.array = None
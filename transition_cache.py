@@ -0,0 +1,82 @@
+from collections import OrderedDict
+
+
+class TransitionCache:
+    def __init__(self, maxsize=100000, velocity_resolution=None):
+        """
+        Bounded LRU cache of the transitions of the simulators.
+
+        An entry holds the next state one candidate power leads to. It is keyed on the velocity, on
+        the class of the road segment (incline, friction, step length) and on the power, so
+        that long stretches of constant grade, or rollouts going through the same states, reuse the
+        transitions instead of recomputing them. The energy does not enter the key, the simulators
+        only cache the energy increments. The vehicle and the physical constants do not enter the key
+        either, a cache is shared only between simulations of the same vehicle and parameters.
+
+        Parameters:
+            maxsize (int): Maximum number of entries, the least recently used one is evicted first.
+            velocity_resolution (float or None): Velocities are rounded to a multiple of this value and
+                                                 the transition is evaluated at the rounded velocity.
+                                                 With None the exact velocity is the key and the
+                                                 results are unchanged by the cache.
+
+        Attributes:
+            hits (int): Number of lookups answered from the cache.
+            misses (int): Number of lookups that computed the transition.
+        """
+        if maxsize <= 0:
+            raise ValueError("Cache size must be positive.")
+        if velocity_resolution is not None and velocity_resolution <= 0:
+            raise ValueError("Velocity resolution must be positive.")
+
+        self.maxsize = maxsize
+        self.velocity_resolution = velocity_resolution
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def quantize(self, velocity):
+        """Returns the velocity at which the transitions of velocity are evaluated."""
+        if self.velocity_resolution is None:
+            return velocity
+        return round(velocity / self.velocity_resolution) * self.velocity_resolution
+
+    def get(self, key, compute):
+        """
+        Returns the entry of key, calling compute() to build it on a miss.
+
+        Parameters:
+            key (hashable): Quantized velocity and segment class, see the simulators.
+            compute (callable): Builds the entry when it is not cached.
+        """
+        try:
+            value = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            value = compute()
+            self.entries[key] = value
+            if len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+            return value
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return value
+
+    def hit_rate(self):
+        """Fraction of lookups answered from the cache."""
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self):
+        """Returns the counters as a dictionary."""
+        return {'hits': self.hits, 'misses': self.misses, 'size': len(self.entries), 'maxsize': self.maxsize,
+                'hit_rate': self.hit_rate()}
+
+    def clear(self):
+        """Drops all entries and resets the counters."""
+        self.entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.entries)